@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# SWAMP - Static Webite Awesome Manager & Producer
+# Benchmarks: builds synthetic websites and measures how long swamp takes
+
+######################## CONFIGUARTION VARIABLES #######################
+
+# Parameters of the synthetic website (see generateWebsite)
+default_parameters = {
+    'directories': 200,      # number of directories in website/
+    'depth': 4,              # maximum depth of the directories
+    'fragments': 3,          # HTML files in each directory
+    'nesting': 3,            # HTML files included one in the other by the template
+    'variables': 5,          # variables in each variables.yaml
+    'locale': 5,             # entries in each locale.yaml
+    'languages': 2,          # number of ALT_LANGUAGES
+    'page_size': 4096,       # bytes of text in the fragments of each page
+    'static_files': 20,      # number of static files
+    'static_size': 65536,    # bytes of each static file
+}
+
+# Seed of the random generator, so that websites are always the same
+random_seed = 1
+
+# File modified to measure a rebuild in watch mode, relative to the website
+watch_changed_file = 'website/body.html'
+
+################################# CODE #################################
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+## Path of swamp.py next to this file
+def defaultSwampPath():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swamp.py')
+
+## Return some text of 'size' bytes
+def loremIpsum(size):
+    text = 'lorem ipsum dolor sit amet consectetur adipiscing elit '
+    return (text * (size // len(text) + 1))[:size]
+
+## Write 'content' in the file 'filename', creating its directory if needed
+def writeFile(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    with open(filename, 'w') as outputfile:
+        outputfile.write(content)
+
+## Generate in 'path' a website using the given parameters. Every directory
+#  has a tag, variables, locale entries in all languages and fragments with
+#  variables, locale strings and links to other pages.
+def generateWebsite(path, parameters):
+    rng = random.Random(random_seed)
+    shutil.rmtree(path, ignore_errors = True)
+    languages = [f'l{i}' for i in range(parameters['languages'])]
+
+    writeFile(os.path.join(path, 'config.yaml'),
+              'LOCATION: "https://example.com/"\nSTATIC: static\nDEFAULT_LANGUAGE: en\n' +
+              ('ALT_LANGUAGES:\n' + ''.join(f'  - {lang}\n' for lang in languages) if languages else ''))
+    writeFile(os.path.join(path, 'variables.yaml'), 'title: Benchmark\n')
+    writeFile(os.path.join(path, 'template.html'),
+              '<!DOCTYPE html>\n<html>\n<head>\n  <title>{$title$}</title>\n  <!-- Benchmark template -->\n'
+              '  <link rel="stylesheet" href="{_static_}/file0.css">\n</head>\n<body>\n'
+              + ('  {#nest0#}\n' if parameters['nesting'] else '') + '  {#body#}\n</body>\n</html>\n')
+
+    os.makedirs(os.path.join(path, 'static'), exist_ok = True)
+    for i in range(parameters['static_files']):
+        with open(os.path.join(path, 'static', f'file{i}.css'), 'wb') as staticfile:
+            staticfile.write(rng.randbytes(parameters['static_size']))
+
+    # Directories, each one child of a random directory not too deep
+    directories = [('', 0)]
+    for i in range(parameters['directories']):
+        parents = [directory for directory in directories if directory[1] < parameters['depth']]
+        parent, depth = rng.choice(parents)
+        directories.append((parent + f'd{i}/', depth + 1))
+
+    # Fragments included one in the other, defined only in the root directory
+    for i in range(parameters['nesting']):
+        inner = f'{{#nest{i + 1}#}}' if i + 1 < parameters['nesting'] else ''
+        writeFile(os.path.join(path, 'website', f'nest{i}.html'),
+                  f'<div class="nest{i}">{{$var0$}} {{%(loc0) Nested%}} {inner}</div>\n')
+
+    fragment_size = parameters['page_size'] // max(1, parameters['fragments'])
+    for number, (directory, depth) in enumerate(directories):
+        directory_path = os.path.join(path, 'website', directory)
+        writeFile(os.path.join(directory_path, 'tag.yaml'), f'tag: page{number}\n')
+        writeFile(os.path.join(directory_path, 'variables.yaml'),
+                  ''.join(f'var{k}: value {k} of {number}\n' for k in range(parameters['variables'])))
+        locale_data = ''.join(f'loc{k}:\n' + ''.join(f'  {lang}: {lang} {k} of {number}\n' for lang in languages)
+                              for k in range(parameters['locale']))
+        if directory and languages:
+            locale_data += 'path_name:\n' + ''.join(f'  {lang}: {lang}-{directory.split("/")[-2]}\n' for lang in languages)
+        writeFile(os.path.join(directory_path, 'locale.yaml'), locale_data)
+
+        parts = ''.join(f'{{#part{j}#}}\n' for j in range(1, parameters['fragments']))
+        writeFile(os.path.join(directory_path, 'body.html'),
+                  f'<main>\n  <h1>{{$var0$}}</h1>\n  <!-- page {number} -->\n{parts}</main>\n')
+        for j in range(1, parameters['fragments']):
+            link = rng.randrange(len(directories))
+            writeFile(os.path.join(directory_path, f'part{j}.html'),
+                      f'<p>{{%(loc{j % max(1, parameters["locale"])}) Part {j}%}} {{$var{j % max(1, parameters["variables"])}$}} '
+                      f'<a href="{{_page{link}_}}">link</a> <a href="{{_self_}}">self</a>\n{loremIpsum(fragment_size)}</p>\n')
+
+## Run swamp.py in the website 'path' with 'args', and return the elapsed
+#  seconds and the peak resident memory in KiB.
+def runBuild(swamp, path, args):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, swamp] + args, cwd = path,
+                               stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    stderr = process.stderr.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f'swamp failed in {path}:\n' + stderr.decode('utf-8', 'replace')[-2000:])
+    return elapsed, usage.ru_maxrss
+
+## Build the website 'path' as in watch mode, change a file and build it again.
+#  It runs in a separate process, whose output is the JSON of the results.
+def watchRebuild(swamp, path):
+    spec = importlib.util.spec_from_file_location('swamp', swamp)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    os.chdir(path)
+    logging.basicConfig(level = logging.WARNING)
+    # Versions of swamp before Builder keep the state in the module
+    builder = module.Builder() if hasattr(module, 'Builder') else module
+
+    start = time.perf_counter()
+    builder.generateWebsite(incremental = True, staged = True)
+    first_build = time.perf_counter() - start
+
+    changed_file = builder.working_path + watch_changed_file
+    with open(changed_file, 'a') as modifiedfile:
+        modifiedfile.write('<p>changed</p>\n')
+    start = time.perf_counter()
+    builder.generateWebsite(incremental = True, changed_paths = {changed_file}, staged = True)
+    rebuild = time.perf_counter() - start
+
+    json.dump({'first_build_seconds': first_build, 'seconds': rebuild,
+               'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, sys.stdout)
+
+## Measure cold builds, warm rebuilds (with the build cache and nothing
+#  changed) and watch rebuilds of a website generated with 'parameters'.
+#  Every measure is repeated 'repeat' times and the fastest one is kept.
+def runBenchmark(swamp, parameters, repeat, args, directory):
+    path = os.path.join(directory, 'site')
+    generateWebsite(path, parameters)
+    results = {'parameters': dict(parameters)}
+
+    def best(measures):
+        elapsed, rss = min(measures)
+        return {'seconds': elapsed, 'peak_rss_kib': max(rss for elapsed, rss in measures)}
+
+    cold = []
+    warm = []
+    for i in range(repeat):
+        shutil.rmtree(os.path.join(path, 'public'), ignore_errors = True)
+        shutil.rmtree(os.path.join(path, '.swamp-cache'), ignore_errors = True)
+        cold.append(runBuild(swamp, path, args + ['--cache']))
+        warm.append(runBuild(swamp, path, args + ['--cache']))
+    results['cold'] = best(cold)
+    results['warm'] = best(warm)
+
+    watch = []
+    for i in range(repeat):
+        generateWebsite(path, parameters)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--watchrebuild', path, '--swamp', swamp],
+                                capture_output = True, check = True)
+        watch.append(json.loads(output.stdout))
+    results['watch'] = min(watch, key = lambda measure: measure['seconds'])
+    results['watch']['peak_rss_kib'] = max(measure['peak_rss_kib'] for measure in watch)
+
+    logging.info(f"{parameters}: cold {results['cold']['seconds']:.3f}s, warm {results['warm']['seconds']:.3f}s, "
+                 f"watch {results['watch']['seconds']:.3f}s")
+    return results
+
+## Return the commit of the repository containing 'swamp', if any
+def getCommit(swamp):
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(swamp)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    argparser = argparse.ArgumentParser(description='Benchmarks of the Static Website Generator.')
+    argparser.add_argument('--swamp',
+                           action = 'store',
+                           default = defaultSwampPath(),
+                           help = """swamp.py to be measured. Default is the one next to this file.""")
+    for name, value in default_parameters.items():
+        argparser.add_argument('--' + name.replace('_', ''),
+                               dest = name,
+                               action = 'store',
+                               type = int,
+                               default = value,
+                               help = f"""Parameter '{name}' of the synthetic website. Default is {value}.""")
+    argparser.add_argument('--curve',
+                           action = 'store',
+                           nargs = 2,
+                           metavar = ('PARAMETER', 'VALUES'),
+                           help = """Measures a scaling curve: the benchmark is run for each of the
+                                     comma separated VALUES of PARAMETER (e.g. directories 100,1000).""")
+    argparser.add_argument('-r', '--repeat',
+                           action = 'store',
+                           type = int,
+                           default = 3,
+                           help = """Times each measure is repeated, the fastest one is kept. Default is 3.""")
+    argparser.add_argument('--args',
+                           action = 'store',
+                           default = '',
+                           help = """Other arguments of swamp.py in cold and warm builds (e.g. "-j 4").""")
+    argparser.add_argument('-o', '--output',
+                           action = 'store',
+                           help = """File where the JSON of the results is written. Default is stdout.""")
+    argparser.add_argument('--keep',
+                           action = 'store',
+                           help = """Directory where the synthetic website is generated and kept.""")
+    argparser.add_argument('--watchrebuild',
+                           action = 'store',
+                           help = argparse.SUPPRESS)
+
+    args_dictionary = vars(argparser.parse_args(args[1:]))
+    swamp = os.path.abspath(args_dictionary['swamp'])
+    if args_dictionary['watchrebuild'] is not None:
+        watchRebuild(swamp, args_dictionary['watchrebuild'])
+        return 0
+    logging.basicConfig(level=logging.INFO)
+
+    parameters = {name: args_dictionary[name] for name in default_parameters}
+    runs = [parameters]
+    if args_dictionary['curve'] is not None:
+        name, values = args_dictionary['curve']
+        if name not in default_parameters:
+            argparser.error(f'unknown parameter {name}, choose from {list(default_parameters)}')
+        runs = [dict(parameters, **{name: int(value)}) for value in values.split(',')]
+
+    directory = args_dictionary['keep'] or tempfile.mkdtemp(prefix = 'swamp-benchmark-')
+    try:
+        results = [runBenchmark(swamp, run, args_dictionary['repeat'], shlex.split(args_dictionary['args']), directory)
+                   for run in runs]
+    finally:
+        if args_dictionary['keep'] is None:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    report = {'swamp': swamp,
+              'commit': getCommit(swamp),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'time': time.time(),
+              'results': results}
+    if args_dictionary['output'] is None:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+    else:
+        with open(args_dictionary['output'], 'w') as outputfile:
+            json.dump(report, outputfile, indent = 2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
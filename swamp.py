@@ -5,7 +5,7 @@
 
 ######################## CONFIGUARTION VARIABLES #######################
 
-#Directory where config files are stored. Absolute Path
+#Directory where config files are stored, by default (see Builder)
 working_path = './'
 #Directory from wich the website is generated. Relative path to working_path
 source_path = 'website/'
@@ -13,58 +13,142 @@ source_path = 'website/'
 public_path = 'public/'
 #Directory where static files are stored. Relative path to working_path
 static_path = 'static/'
+#Directory where the build cache is stored. Relative path to working_path
+cache_path = '.swamp-cache/'
+#Directory where the derivatives of static images are stored. Relative path to working_path
+images_cache_path = cache_path + 'images/'
+#Directory where the compressed variants of static files are stored. Relative path to working_path
+compressed_cache_path = cache_path + 'compressed/'
+#Directory where the files of the search index are stored before being published. Relative path to working_path
+search_cache_path = cache_path + 'search/'
+#Directory where the website is built before replacing public_path, when the
+#output is staged. Relative path to working_path
+staging_path = cache_path + 'stage/'
 
 needed_global_conf = ['LOCATION', 'STATIC', 'DEFAULT_LANGUAGE']
 
 # Key to be pressed to stop the program in watch mode
 stop_key = 'q'
 
+# Number of threads copying static files
+static_copy_threads = 8
+
+# Number of threads writing the pages built, and maximum number of pages
+# waiting to be written (see PageWriter)
+page_writer_threads = 8
+page_writer_queue_depth = 64
+
+# ioctl to clone a file on filesystems supporting reflinks (Linux)
+FICLONE = 0x40049409
+
+# Flag of renameat2 to exchange two paths atomically (Linux)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# Hexadecimal digits of the digest added to the names of fingerprinted static
+# files, and name of the manifest of static files written in public_path
+fingerprint_length = 16
+asset_manifest_name = 'asset-manifest.json'
+
+# Name of the deploy manifest written in cache_path (see writeDeployManifest),
+# and of the record of the files uploaded (see uploadWebsite)
+deploy_manifest_name = 'deploy-manifest.json'
+uploaded_manifest_name = 'uploaded.json'
+
+# Number of concurrent connections uploading the website
+upload_connections = 16
+
+# Extensions of the static images from which derivatives are generated, when
+# IMAGE_WIDTHS is in the configuration, and default format and quality
+image_extensions = ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp']
+default_image_formats = ['webp']
+default_image_quality = 80
+
+# Compressed variants of pages and static files written with --precompress:
+# files smaller than precompress_min_size bytes are not compressed, and a
+# variant is kept only if it is not bigger than precompress_max_ratio times
+# the file. Compression levels of gzip and brotli, and number of threads
+# compressing static files (pages are compressed by the PageWriter).
+precompress_min_size = 1024
+precompress_max_ratio = 0.9
+precompress_gzip_level = 9
+precompress_brotli_quality = 11
+precompress_threads = 8
+
+# Search index written with --search, in the directory search_directory of
+# the static files: a directory for each language, with the documents and the
+# shards of the index. The terms of a shard start with the same
+# search_shard_prefix characters, and only terms from search_min_term_length
+# to search_max_term_length characters are indexed.
+search_directory = 'search'
+search_documents_name = 'documents.json'
+search_shard_prefix = 2
+search_min_term_length = 2
+search_max_term_length = 40
+
+# Maximum nesting of variables and locale values containing other expressions
+max_expression_depth = 64
+
+# Maximum number of parsed YAML files kept in memory (see loadYAML)
+yaml_cache_size = 4096
+
 # Seconds enlapsed between 2 checks of modifications in watch mode
 watch_waiting_time = 0.4
+# Seconds without modifications before a build starts in watch mode
+watch_debounce_time = 0.3
 
 # Default Web Server Port
 default_webserver_port = 8000
 default_webserver_address = 'localhost'
 
+# Bytes of pages kept in memory by the web server
+dev_server_memory = 64 * 1024 * 1024
+# Files bigger than this are not compressed and sent without ETag
+dev_server_max_file_size = 8 * 1024 * 1024
+# Types of not textual files compressed by the web server
+compressible_types = ['application/javascript', 'application/json', 'application/xml', 'image/svg+xml']
+
+# URL of the Server-Sent Events stream of live reload, and script added to
+# the pages to reload them when they change ('*' means everything)
+live_reload_url = '/__swamp/livereload'
+live_reload_script = """<script>new EventSource('/__swamp/livereload').addEventListener('reload', function (event) {
+  var urls = JSON.parse(event.data);
+  if (urls.some(function (url) { return url === '*' || url === location.pathname || !url.endsWith('/'); })) location.reload();
+});</script>"""
+# Maximum number of URLs sent in a live reload event
+live_reload_max_urls = 1000
+# URL of the status of the builds of watch mode (see BuildScheduler.getStatus)
+build_status_url = '/__swamp/status'
+
 # Excluding when detecting changes
-exclude_dirs = ['.git', 'venv', '__pycache__', '.vscode', 'public', 'swamp']
+exclude_dirs = ['.git', 'venv', '__pycache__', '.vscode', 'public', 'swamp', '.swamp-cache']
 excluding_files = ['swamp.py','.DS_Store', '.gitignore', '.gitmodules']
 
 ########################### GLOBAL VARIABLES ###########################
-# Dictioanry of global configuration.
-config = {}
+# Identifier of this version of swamp (see getSwampVersion)
+swamp_version = None
 
-# List of dictionaries of variables. Each element of the list is a dictioanry
-# of variables contained in a subpath. It is used as a stack during the
-# DFS of directories.
-variables = []
-# List of dictionaries of files. Each element of the list is a dictioanry
-# of HTML files contained in a subpath. It is used as a stack during the
-# DFS of directories.
-HTML_files = []
+# Cache of localized tags: each key is a tuple (tag name, language) and its
+# value the tuple (name, suffix) used by localizedTag.
+localized_tags = {}
 
-# Dictionary of list of dictionary. Each key is a language and its value a list
-# used as a stack during DFS of directories. Each element of each list is a dictionary
-# of language entries contained in a subpath
-locale = {}
+# Builder of a worker process building pages (see initializeWorker)
+worker_builder = None
 
-# Dictionary of links
-links = {}
-
-# Template File
-template = ''
+########################### EXCEPTIONS ################################
+class NoLocaleError(Exception):
+    pass
 
-# List of alternative languages
-alt_languages = []
+class TemplateError(Exception):
+    pass
 
-# Dictionary of alternative languages path name for directory exploring
-alt_languages_path = {}
+class LinkError(Exception):
+    pass
 
-# Boolean to create a subdirectory for the default languages
-subdirectory_default_language = False
+class UploadError(Exception):
+    pass
 
-########################### EXCEPTIONS ################################
-class NoLocaleError(Exception):
+class BuildCancelled(Exception):
     pass
 
 ################################# CODE #################################
@@ -77,15 +161,67 @@ import shutil
 import os
 import logging
 import argparse
+import asyncio
 from hashlib import sha256
 import getkey
 import threading
 import signal
 import time
 import hashlib
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import hmac
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import http.client
+import mimetypes
 import datetime
 import re
+import sys
+import struct
+import ctypes
+import ctypes.util
+import multiprocessing
+import concurrent.futures
+import json
+import csv
+import itertools
+import pickle
+import glob
+import collections
+import queue
+import gzip
+import urllib.parse
+import html
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# Pillow is needed only to generate image derivatives
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+# brotli is needed only to precompress files with brotli
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# libyaml's loader is much faster, the pure Python one is used if not available
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Regular expressions used by removeCommentsFromHTML and minifyHTML. None of
+# them backtracks, so HTML code is always scanned in linear time.
+html_special_regex = re.compile(r'<!--|<(script|style|pre|textarea)(?=[\s/>])', re.IGNORECASE)
+whitespaces_regex = re.compile(r'\s+')
+html_tag_regex = re.compile(r'<[a-zA-Z][^<>]*>')
+tag_name_regex = re.compile(r'<[a-zA-Z][^\s/>]*')
+attribute_regex = re.compile(r'\s*[^\s"\'<>/=]+(?:(\s*=\s*)(?:"([^"]*)"|\'([^\']*)\'|[^\s"\'=<>`]+))?')
+unquoted_value_regex = re.compile(r'[^\s"\'=<>`{}]+')
+
+# Regular expressions used by extractSearchDocument
+search_skipped_regex = re.compile(r'<(head|script|style|template|noscript)(?=[\s/>]).*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+search_title_regex = re.compile(r'<title(?=[\s>])[^>]*>(.*?)</title\s*>', re.IGNORECASE | re.DOTALL)
+search_tag_regex = re.compile(r'<[^<>]*>')
+search_term_regex = re.compile(r'\w+')
 
 ## Add a '/' charracter at the end of the string path if it is not already
 #  there
@@ -106,6 +242,11 @@ def makePathNormalized(path):
         return ''
     return makePathEndWithSlash(makePathStartWithoutSlash(path))
 
+## Return True if 'name' can be the name of the directory of a page: a single
+#  path segment, not empty and not '.' or '..'.
+def isValidPathName(name):
+    return name not in ('', '.', '..') and '/' not in name and '\\' not in name
+
 ## Return the name of last considered dir in a path.
 #  Example: "some/strange/dire" --> "dire"
 def getLastDirNameInPath(path):
@@ -122,8 +263,9 @@ def popLastDirNameInPath(path):
     return makePathEndWithSlash(path[:-(len(getLastDirNameInPath(path))+1)])
 
 ## Given a path it explores all subdirectories (ignoring files!) and calls
-#  pre before scanning actual dir and post after scanning
-def exploreSubdirectory(path, pre = None, post = None):
+#  pre before scanning actual dir and post after scanning. If explore is
+#  given, only subdirectories for which it returns True are explored.
+def exploreSubdirectory(path, pre = None, post = None, explore = None):
     # Assert that path is correctly formatted
     path = makePathEndWithSlash(path)
 
@@ -131,15 +273,17 @@ def exploreSubdirectory(path, pre = None, post = None):
         pre(path)
 
     for entry in os.scandir(path):
-        if entry.is_dir():
-            exploreSubdirectory(entry.path, pre, post)
+        if entry.is_dir() and (explore is None or explore(entry.path)):
+            exploreSubdirectory(entry.path, pre, post, explore)
 
     if callable(post):
         post(path)
 
-# Remove all contents of path. path must be a folder
-def emptyFolder(path):
+# Remove all contents of path, except the elements in keep. path must be a folder
+def emptyFolder(path, keep = ()):
     for element in os.listdir(path):
+        if element in keep:
+            continue
         complete_path = os.path.join(path, element)
         try:
             if os.path.isfile(complete_path):
@@ -149,419 +293,3120 @@ def emptyFolder(path):
         except Exception as e:
             logging.error("while empting {0} the following error: {1}".format(path, e))
 
-## Remove all comments from an HTML code
-def removeCommentsFromHTML(html_code):
-    return re.sub(r"<!--(.|\s|\n)*?-->", "", html_code)
+## Remove all comments from an HTML code with a single scan. Conditional
+#  comments are kept, as the content of <script>, <style> and <textarea>. If
+#  'minify' is not None the code is also minified (see minifyHTML), except
+#  the content of those elements and of <pre>. If 'raw_ranges' is a list, the
+#  ranges (start, end) of the output that are the content of those elements
+#  are appended to it.
+def removeCommentsFromHTML(html_code, minify = None, raw_ranges = None):
+    lower_code = None
+    # End found by the last search of each string: a search starting before it
+    # finds the same end, so the code is scanned only once for each string
+    ends = {}
+    def findEnd(code, string, start):
+        end = ends.get(string)
+        if end is None or end < start:
+            end = code.find(string, start)
+            if end == -1:
+                end = len(code)
+            ends[string] = end
+        return end
+
+    output = []
+    output_length = 0
+    def emit(code):
+        nonlocal output_length
+        output.append(code)
+        output_length += len(code)
+
+    position = 0
+    # End of the content of the <pre> element being scanned, if any
+    pre_end = None
+    pre_start = None
+    while True:
+        limit = len(html_code) if pre_end is None else pre_end
+        text_minify = minify if pre_end is None else None
+        match = html_special_regex.search(html_code, position, limit)
+        if match is None:
+            emit(minifyHTML(html_code[position:limit], text_minify))
+            if pre_end is None:
+                break
+            if raw_ranges is not None:
+                raw_ranges.append((pre_start, output_length))
+            position = pre_end
+            pre_end = None
+            continue
+        emit(minifyHTML(html_code[position:match.start()], text_minify))
+
+        if match.group(1) is None:
+            end_index = findEnd(html_code, '-->', match.end())
+            # A comment that is not terminated is kept as it is
+            if end_index + 3 > limit:
+                emit(html_code[match.start():limit])
+                position = limit
+                continue
+            if html_code.startswith(('[if', '<![endif]'), match.end()):
+                emit(html_code[match.start():end_index + 3])
+            position = end_index + 3
+            continue
+
+        # Elements whose content is not minified
+        element = match.group(1).lower()
+        start_index = findEnd(html_code, '>', match.end())
+        if start_index >= limit:
+            emit(html_code[match.start():limit])
+            position = limit
+            continue
+        emit(minifyHTML(html_code[match.start():start_index + 1], text_minify))
+        if lower_code is None:
+            lower_code = html_code.lower()
+        end_index = min(findEnd(lower_code, '</' + element, start_index + 1), limit)
+        if element == 'pre':
+            # Comments are removed also from the content of <pre>, without minifying it
+            position = start_index + 1
+            if pre_end is None:
+                pre_start = output_length
+            pre_end = end_index
+        else:
+            if raw_ranges is not None:
+                raw_ranges.append((output_length, output_length + end_index - start_index - 1))
+            emit(html_code[start_index + 1:end_index])
+            position = end_index
+    return ''.join(output)
+
+## Minify the HTML code: if 'minify' is 'whitespace' consecutive whitespaces
+#  are replaced by a single space, if it is 'quotes' the quotes around the
+#  attribute values that do not need them are also removed. Values containing
+#  expressions keep their quotes, since their content is not known yet.
+def minifyHTML(html_code, minify):
+    if minify is None:
+        return html_code
+    html_code = whitespaces_regex.sub(' ', html_code)
+    if minify == 'quotes':
+        html_code = html_tag_regex.sub(lambda match: removeAttributeQuotes(match.group(0)), html_code)
+    return html_code
+
+## Remove the quotes around the attribute values of the HTML tag 'tag' that do
+#  not need them. Attributes are read in order, so only whole values are
+#  unquoted, and the tag is kept as it is from the first thing that is not an
+#  attribute. A value not followed by a space or by the end of the tag keeps
+#  its quotes, not to take what follows (like the '/' of '<br a="b"/>').
+def removeAttributeQuotes(tag):
+    position = tag_name_regex.match(tag).end()
+    output = [tag[:position]]
+    while True:
+        match = attribute_regex.match(tag, position)
+        if match is None:
+            break
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        following = tag[match.end():match.end() + 1]
+        if value is not None and unquoted_value_regex.fullmatch(value) and (following == '>' or following.isspace()):
+            output.append(tag[position:match.end(1)] + value)
+        else:
+            output.append(match.group(0))
+        position = match.end()
+    output.append(tag[position:])
+    return ''.join(output)
+
+## Push on 'stack' the scope of a directory, containing all the entries of the
+#  actual scope and the ones in the dictionary 'entries' (that win). Scopes are
+#  never modified once pushed, so a directory that does not add any entry
+#  shares the dictionary of its parent: every lookup is a single access and
+#  only the directories defining something take memory.
+def pushScope(stack, entries):
+    if not stack:
+        stack.append(dict(entries))
+    elif entries:
+        scope = dict(stack[-1])
+        scope.update(entries)
+        stack.append(scope)
+    else:
+        stack.append(stack[-1])
+
+## Return the key of the tag 'name' in the language 'lang' in the dictionary
+#  links. The parts of the key of each (name, lang) are computed only once and
+#  kept in localized_tags.
+def localizedTag(name, lang, self_tag_name = None):
+    try:
+        build_name, build_local = localized_tags[(name, lang)]
+    except KeyError:
+        build_local = sha256(lang.encode('utf-8')).hexdigest()
+        build_name = name
+        open_square_bracket = name.find('[')
+        close_square_bracket = name.find(']')
+        if open_square_bracket != -1 and close_square_bracket !=-1:
+            build_local = sha256(name[open_square_bracket+1:close_square_bracket].encode('utf-8')).hexdigest()
+            build_name = name[:open_square_bracket]
+        else:
+            build_name = name
+        if name == 'static':
+            build_local = ''
+        localized_tags[(name, lang)] = (build_name, build_local)
+
+    # Special names
+    if name != 'static' and build_name == 'self' and self_tag_name is not None:
+        build_name = self_tag_name
+
+    if build_name == 'self':
+        print(name, lang, self_tag_name, build_name, build_local)
+
+    return build_name + build_local
 
-## Load a configuaration file given the path (NB: the path DOES NOT
-#  include filename, wich is assumed to be 'config.yaml' by default) and
-#  stores it in the global variable config.
-def loadConfig(path):
-    with open(path + 'config.yaml', 'r') as conffile:
-        confdata = yaml.safe_load(conffile.read())
+## Return the state (modification time and size) of a file, or None if the
+#  file does not exist. It is used to detect which files changed.
+def fileState(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+## Return an identifier of this version of swamp, used to invalidate the
+#  build cache when the program changes.
+def getSwampVersion():
+    global swamp_version
+    if swamp_version is None:
+        with open(os.path.abspath(__file__), 'rb') as swampfile:
+            swamp_version = sha256(swampfile.read()).hexdigest()
+    return swamp_version
+
+## Compile the HTML code into a list of nodes, that can be rendered with a
+#  single walk. A node is either a string (plain code) or a tuple
+#  (mark, name, default, source, offset) representing an expression in the
+#  form {'mark' name 'mark'}. For locale expressions 'default' is the compiled
+#  localedescription, for files it is True if they are included in an element
+#  that is not minified (see markRawFiles), otherwise it is None. Only the expressions whose mark
+#  is in 'marks' are compiled, the others are left as plain code.
+#  'source' and 'offset' are used to report where errors are.
+def compileTemplate(code, source, marks = '#$%_', base_offset = 0):
+    nodes = []
+    plain_start = 0
+    start_index = code.find('{')
+    while start_index != -1:
+        mark = code[start_index + 1:start_index + 2]
+        if mark == '' or mark not in marks:
+            start_index = code.find('{', start_index + 1)
+            continue
+
+        offset = base_offset + start_index
+        end_index = code.find(mark + '}', start_index + 2)
+        if end_index == -1:
+            raise TemplateError(f'{source}, offset {offset}: missing end of expression "{{{mark}"')
+
+        if plain_start < start_index:
+            nodes.append(code[plain_start:start_index])
+        content = code[start_index + 2:end_index]
+
+        if mark == '%':
+            open_bracket = content.find('(')
+            close_bracket = content.find(')')
+            if open_bracket == -1 or close_bracket < open_bracket:
+                raise TemplateError(f'{source}, offset {offset}: locale expression without "(localetag)"')
+            default = compileTemplate(content[close_bracket + 1:], source, marks,
+                                      offset + 2 + close_bracket + 1)
+            nodes.append((mark, content[open_bracket + 1:close_bracket], default, source, offset))
+        else:
+            nodes.append((mark, content, None, source, offset))
+
+        plain_start = end_index + 2
+        start_index = code.find('{', plain_start)
+
+    if plain_start < len(code):
+        nodes.append(code[plain_start:])
+    return nodes
+
+## Mark the file expressions of the compiled 'nodes' whose offset is in one of
+#  'raw_ranges' (see removeCommentsFromHTML): their 'default' becomes True, so
+#  that the file is included without being minified.
+def markRawFiles(nodes, raw_ranges):
+    marked = []
+    for node in nodes:
+        if isinstance(node, str):
+            marked.append(node)
+        elif node[0] == '#' and any(start <= node[4] < end for start, end in raw_ranges):
+            marked.append((node[0], node[1], True, node[3], node[4]))
+        elif node[0] == '%':
+            marked.append((node[0], node[1], markRawFiles(node[2], raw_ranges), node[3], node[4]))
+        else:
+            marked.append(node)
+    return marked
+
+## Return the name of the static file 'name' with the first digits of its
+#  digest before the extension. Example: "css/site.css" --> "css/site.0123456789abcdef.css"
+def fingerprintName(name, digest):
+    directory, filename = os.path.split(name)
+    root, extension = os.path.splitext(filename)
+    return os.path.join(directory, root + '.' + digest[:fingerprint_length] + extension).replace(os.sep, '/')
+
+## Return the filename in 'directory' (images_cache_path) of the derivative
+#  of the image whose digest is 'digest', with the given width, format and
+#  quality. The name depends only on them, so each derivative is generated
+#  only once.
+def imageDerivativeName(directory, digest, width, image_format, quality):
+    derivative_id = sha256(f'{digest}-{width}-{quality}'.encode('utf-8')).hexdigest()
+    return directory + derivative_id + '.' + image_format
+
+## Return the widths of the derivatives of an image 'image_width' pixels wide:
+#  the ones in 'widths' not bigger than the image, or the width of the image
+#  if they are all bigger. Images are never enlarged.
+def getImageWidths(image_width, widths):
+    return [width for width in widths if width <= image_width] or [image_width]
+
+## Generate the derivatives of the image 'source', whose digest is 'digest',
+#  in the given formats and widths (see getImageWidths) that are not already
+#  in 'directory'. It is run by worker processes and returns the size of the
+#  image.
+def convertImage(source, digest, directory, widths, image_formats, quality):
+    with Image.open(source) as image:
+        image.load()
+        size = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        for width in getImageWidths(size[0], widths):
+            height = max(1, round(size[1] * width / size[0]))
+            resized = None
+            for image_format in image_formats:
+                filename = imageDerivativeName(directory, digest, width, image_format, quality)
+                if os.path.isfile(filename):
+                    continue
+                if resized is None:
+                    resized = image if width == size[0] else image.resize((width, height), Image.Resampling.LANCZOS)
+                resized.save(filename + '.tmp', format = image_format.upper(), quality = quality)
+                os.replace(filename + '.tmp', filename)
+    return size
+
+## Return True if the published static file 'destination' is the same as
+#  'source'. Files are compared by size and modification time, and if
+#  'checksum' is True by content when the modification time differs.
+#  In hardlink mode they must be the same file.
+def isStaticFileSynced(source, destination, mode, checksum):
+    if not os.path.isfile(destination) or os.path.islink(destination):
+        return False
+    source_stat = os.stat(source)
+    destination_stat = os.stat(destination)
+    if mode == 'hardlink':
+        return os.path.samestat(source_stat, destination_stat)
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    if source_stat.st_mtime_ns == destination_stat.st_mtime_ns:
+        return True
+    if checksum and fileChecksum(source) == fileChecksum(destination):
+        shutil.copystat(source, destination)
+        return True
+    return False
+
+## Publish the static file 'source' in 'destination'. In hardlink and reflink
+#  mode no data is copied, if the filesystem supports it.
+def copyStaticFile(source, destination, mode):
+    try:
+        os.makedirs(os.path.dirname(destination), exist_ok = True)
+        # The old file is removed, also not to write through a hardlink
+        if os.path.lexists(destination):
+            os.remove(destination)
+        if mode == 'hardlink':
+            try:
+                os.link(source, destination)
+                return
+            except OSError:
+                pass
+        elif mode == 'reflink' and fcntl is not None:
+            try:
+                with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+                    fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                shutil.copystat(source, destination)
+                return
+            except OSError:
+                pass
+        shutil.copy2(source, destination)
+    except Exception as e:
+        logging.error(f'while copyng {source} the following error: {e}')
+
+## Return True if the file 'name' is worth compressing, given its type: text
+#  files and the types in compressible_types.
+def isCompressible(name):
+    content_type = mimetypes.guess_type(name)[0]
+    return content_type is not None and (content_type.startswith('text/') or content_type in compressible_types)
+
+## Return 'data' compressed with 'encoding': 'gz' (gzip) or 'br' (brotli).
+#  The output depends only on the data, so gzip does not store the time.
+def compressData(data, encoding):
+    if encoding == 'gz':
+        return gzip.compress(data, compresslevel = precompress_gzip_level, mtime = 0)
+    return brotli.compress(data, quality = precompress_brotli_quality)
+
+## Write the compressed variants of the file 'filename', whose content is
+#  'data', next to it: 'filename.gz' and 'filename.br' for the encodings in
+#  'encodings'. Small files and the variants that are not enough smaller are
+#  not written (see precompress_min_size and precompress_max_ratio).
+def writeCompressedFiles(filename, data, encodings):
+    try:
+        if len(data) < precompress_min_size:
+            return
+        for encoding in encodings:
+            compressed = compressData(data, encoding)
+            if len(compressed) <= len(data) * precompress_max_ratio:
+                with open(filename + '.' + encoding, 'wb') as compressedfile:
+                    compressedfile.write(compressed)
+    except Exception as e:
+        logging.error(f'while compressing {filename} the following error: {e}')
+
+## Write the page 'data' (bytes) in the file 'filename', and its compressed
+#  variants in 'encodings' (see writeCompressedFiles). The old files are
+#  removed, not to write through a hardlink to a published page, and the old
+#  compressed variants also if they are not written again.
+def writePage(filename, data, encodings):
+    for old_filename in [filename] + [filename + '.' + encoding for encoding in ('gz', 'br')]:
+        try:
+            os.remove(old_filename)
+        except FileNotFoundError:
+            pass
+    with open(filename, 'wb') as destination_file:
+        destination_file.write(data)
+    logging.debug('Created {0}'.format(filename))
+    if encodings:
+        writeCompressedFiles(filename, data, encodings)
+
+## Return the title of the HTML page 'code' and its terms: a dictionary whose
+#  keys are the words of its text, lowercase, and their values the number of
+#  occurrences. The head, scripts, styles and comments are not text.
+def extractSearchDocument(code):
+    title = search_title_regex.search(code)
+    title = whitespaces_regex.sub(' ', html.unescape(title.group(1))).strip() if title is not None else ''
+    text = html.unescape(search_tag_regex.sub(' ', search_skipped_regex.sub(' ', code)))
+    terms = collections.Counter(term for term in search_term_regex.findall(text.lower())
+                                if search_min_term_length <= len(term) <= search_max_term_length)
+    return title, dict(terms)
+
+## Return the name of the shard of the search index containing 'term': the
+#  hexadecimal UTF-8 encoding of its first search_shard_prefix characters.
+def searchShardName(term):
+    return term[:search_shard_prefix].encode('utf-8').hex()
+
+## Threads writing the pages built (see writePage), so pages are rendered while
+#  others are written. At most 'depth' pages wait to be written, and the builder
+#  waits when they are more, so the memory used does not grow with the website.
+#  Each directory is created only once, by the first page written in it.
+#  Errors are raised by the next write, or by close.
+class PageWriter:
+    def __init__(self, threads, depth, encodings):
+        self.encodings = encodings
+        self.queue = queue.Queue(maxsize = depth)
+        self.directories = set()
+        self.errors = []
+        self.closed = False
+        self.threads = [threading.Thread(target = self.run, daemon = True) for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    ## Write the pages in the queue, until None is received
+    def run(self):
+        while True:
+            page = self.queue.get()
+            if page is None:
+                return
+            filename, data = page
+            try:
+                directory = os.path.dirname(filename)
+                if directory not in self.directories:
+                    os.makedirs(directory, exist_ok = True)
+                    self.directories.add(directory)
+                writePage(filename, data, self.encodings)
+            except Exception as e:
+                self.errors.append(e)
+
+    ## Queue the page 'data' (bytes) to be written in the file 'filename'
+    def write(self, filename, data):
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((filename, data))
+
+    ## Wait for the pages in the queue to be written, and stop the threads
+    def join(self):
+        if not self.closed:
+            self.closed = True
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+
+    ## Wait for the pages in the queue to be written, and raise the first error
+    def close(self):
+        self.join()
+        if self.errors:
+            raise self.errors[0]
+
+## Hardlink the file source to destination, or copy it if links are not supported
+def linkOrCopyFile(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+## Exchange atomically the directories first and second. It returns False if
+#  the system does not support it.
+def exchangeDirectories(first, second):
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        return libc.renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0
+    except AttributeError:
+        return False
+
+## Builder of the website in 'working_path'. It holds the whole state of a
+#  build, so the same process can build many websites, one after another or
+#  at the same time from different threads (see generateWebsiteAsync). The
+#  state of the last build is kept to build the website again incrementally.
+class Builder:
+    def __init__(self, working_path = working_path):
+        # Directory where config files are stored
+        self.working_path = makePathEndWithSlash(working_path)
+
+        # Lock held while the website is being built, so builds of the same
+        # website never overlap
+        self.lock = threading.Lock()
+
+        # Set to stop the build running as soon as possible (see cancel)
+        self.cancelled = threading.Event()
+
+        # Dictioanry of global configuration.
+        self.config = {}
+
+        # List of dictionaries of variables. Each element of the list is a dictioanry
+        # of all the variables visible in a subpath (see pushScope). It is used as a
+        # stack during the DFS of directories.
+        self.variables = []
+        # List of dictionaries of files. Each element of the list is a dictioanry
+        # of all the HTML files visible in a subpath, with the name of each file as key
+        # and its filename as value. It is used as a stack during the DFS of directories.
+        self.HTML_files = []
+
+        # Cache of the HTML files compiled during the actual build: each key is a
+        # tuple (filename, raw) and its value the compiled code (see getHTMLFile)
+        self.compiled_HTML_files = {}
+
+        # Cache of the variable and locale values compiled during the actual
+        # build: each key is a tuple (value, source, marks) (see compileValue)
+        self.compiled_values = {}
+
+        # Dictionary of list of dictionary. Each key is a language and its value a list
+        # used as a stack during DFS of directories. Each element of each list is a dictionary
+        # of all the language entries visible in a subpath
+        self.locale = {}
+
+        # Dictionary of links. Each key is a localized tag and its value the path of
+        # the page relative to public_path. It is filled before building any page.
+        self.links = {}
+
+        # Dictionary of pages. Each key is a directory of source_path and its value a
+        # tuple with the tag of the directory and a dictionary containing the path of
+        # the page (relative to public_path) for each language.
+        self.pages = {}
+
+        # Collections: directories containing the file 'collection.yaml' generate a
+        # page for each record of a data file (see readCollection). collection_paths
+        # is a dictionary whose keys are these directories and values the list of the
+        # paths of the pages of their records, in the order of the data file.
+        # collection_pages is a dictionary whose keys are the paths of those pages and
+        # values a tuple with the directory, the index of the record and its digest.
+        self.collection_paths = {}
+        self.collection_pages = {}
+
+        # Scope of HTML files of the pages of each collection, shared by its records
+        # (see loadRecord)
+        self.collection_scopes = {}
+
+        # Set of the localized tags of the links in the page being built
+        self.rendered_links = set()
+
+        # True if the page being built contains the timestamp.
+        self.rendered_timestamp = False
+
+        # Build cache: the content of the file 'build.json' in cache_path. It is a
+        # dictionary with the version of swamp, the state and digest of the files
+        # read ('files') and the key, path and dependencies of each page ('pages').
+        # None if the cache is not used.
+        self.build_cache = None
+
+        # Dictionary of the digests of the files computed during the actual build
+        self.file_digests = {}
+
+        # Parsed YAML files: each key is a filename and its value a tuple with the
+        # state of the file (see fileState) and its document. The order of the keys
+        # is the order of use, the first one is evicted when the cache is full.
+        self.yaml_documents = {}
+
+        # True if yaml_documents changed since it was loaded from or saved to the
+        # file 'yaml.pickle' in cache_path.
+        self.yaml_documents_changed = False
+
+        # Names of the YAML files parsed by a worker process, to be sent to the
+        # main process (see buildPagesInWorker). None in the main process.
+        self.parsed_yaml_files = None
+
+        # Dictionary of the dependencies of each page, used in watch mode to rebuild
+        # only the pages affected by a change. Each key is a directory of source_path
+        # and its value a tuple with the set of files read to build its page (in all
+        # languages) and the set of localized tags of its links.
+        self.dependencies = {}
+
+        # Dictionary of the state of each file read during the last build (see
+        # fileState), and of the state of the static directory.
+        self.file_states = {}
+        self.static_state = {}
+
+        # Static files to be published: each key is the path relative to the static
+        # directory of the output and its value the path of the file (see
+        # getStaticFiles, with the fingerprinted names too). They are updated only
+        # when static files change, as static_links: a dictionary of the links to each
+        # static file ('static:' followed by its name, see getStaticLinks).
+        self.static_files = {}
+        self.static_links = {}
+
+        # Dictionary of the digests of static files: each key is a filename and its
+        # value a tuple with its state (see fileState) and the SHA-256 of its content.
+        self.static_digests = {}
+
+        # Dictionary of the sizes of static images: each key is the digest of an
+        # image and its value the list [width, height]. It is saved in the file
+        # 'sizes.json' of images_cache_path.
+        self.image_sizes = None
+
+        # Directory where the website is being written, relative to working_path:
+        # public_path or staging_path.
+        self.output_path = public_path
+
+        # Pages kept in memory by the web server of watch mode (see MemoryPages).
+        # None if the web server is not running.
+        self.memory_pages = None
+
+        # Dictionary of the digests of the pages written during the build, with their
+        # path relative to public_path as key. None if they are not needed.
+        self.pushed_pages = None
+
+        # Set of queues of the pages connected for live reload, and its lock
+        self.live_reload_clients = set()
+        self.live_reload_lock = threading.Lock()
+
+        # Set of directories whose page has to be built. None means all.
+        self.pages_to_build = None
+
+        # Stack of the directories whose data is loaded (see loadDirectory)
+        self.loaded_directories = []
+
+        # Dictionary of links to unknown tags found while building the pages. Each key
+        # is a tuple (expression, language, source, offset) and its value the number
+        # of pages containing it.
+        self.dangling_links = {}
+
+        # Dictionary of variables not defined found while building the pages. Each key
+        # is a tuple (expression, source, offset) and its value the set of directories
+        # whose scope did not contain it.
+        self.undefined_variables = {}
+
+        # If True undefined variables are errors, otherwise they are rendered as "None"
+        self.strict_mode = False
+
+        # Minification of the HTML code: None, 'whitespace' or 'quotes' (see minifyHTML)
+        self.minify_mode = None
+
+        # Extensions of the compressed variants written next to pages and static
+        # files ('gz' and 'br'), empty if they are not written.
+        self.precompress_encodings = []
+
+        # Writer of the pages while they are built (see PageWriter). If it is
+        # None, pages are written when they are built.
+        self.page_writer = None
+
+        # Search index of the pages (see SearchIndex), None if it is not built,
+        # the documents of the pages built by the build running, by directory,
+        # and the files of the index published in the static directory.
+        self.search_index = None
+        self.indexed_pages = {}
+        self.search_files = {}
+
+        # Profile of the build (see startProfile), None if the build is not profiled.
+        # It is a dictionary with the trace events ('events'), the seconds spent in
+        # each phase ('phases') and in each page ('pages'), and the counters
+        # ('counters') of expressions expanded, bytes read and written, and so on.
+        self.profile = None
+
+        # Template File, compiled as a list of nodes (see compileTemplate)
+        self.template = []
+
+        # Stack of dictionaries of expanded HTML files, parallel to HTML_files. A
+        # directory that does not add any HTML file shares the dictionary of its
+        # parent, so fragments are expanded only once for each scope.
+        self.expanded_HTML_files = []
+
+        # List of alternative languages
+        self.alt_languages = []
+
+        # Dictionary of alternative languages path name for directory exploring
+        self.alt_languages_path = {}
+
+        # Boolean to create a subdirectory for the default languages
+        self.subdirectory_default_language = False
+
+    ## Start profiling the build. All times are measured with time.perf_counter
+    #  from 'start', also in the worker processes.
+    def startProfile(self):
+        self.profile = {'start': time.perf_counter(), 'events': [], 'phases': {}, 'pages': {},
+                        'counters': collections.Counter()}
+
+    ## Add to the profile an event of the category 'category' named 'name', that
+    #  started at 'start' and ends now. It returns the seconds elapsed.
+    def profileEvent(self, category, name, start, args = None):
+        end = time.perf_counter()
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': (start - self.profile['start']) * 1e6, 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if args is not None:
+            event['args'] = args
+        self.profile['events'].append(event)
+        return end - start
+
+    ## Add to the profile the phase 'name' of the build, that started at 'start'
+    def profilePhase(self, name, start):
+        self.profile['phases'][name] = self.profile['phases'].get(name, 0) + self.profileEvent('phase', name, start)
+
+    ## Write the summary of the profile in 'profile.json' and the trace events in
+    #  'trace.json' (Chrome trace event format, see chrome://tracing or Perfetto)
+    #  in cache_path.
+    def saveProfile(self, slowest = 50):
+        pages_time = sorted(self.profile['pages'].items(), key = lambda item: item[1], reverse = True)
+        fragments_time = collections.Counter()
+        for event in self.profile['events']:
+            if event['cat'] == 'fragment':
+                fragments_time[event['name']] += event['dur'] / 1e6
+        summary = {'total': time.perf_counter() - self.profile['start'],
+                   'phases': self.profile['phases'],
+                   'pages': len(self.profile['pages']),
+                   'slowest_pages': pages_time[:slowest],
+                   'slowest_fragments': fragments_time.most_common(slowest),
+                   'counters': dict(self.profile['counters'])}
+        os.makedirs(self.working_path + cache_path, exist_ok = True)
+        with open(self.working_path + cache_path + 'profile.json', 'w') as profilefile:
+            json.dump(summary, profilefile, indent = 2)
+        with open(self.working_path + cache_path + 'trace.json', 'w') as tracefile:
+            json.dump({'traceEvents': self.profile['events'], 'displayTimeUnit': 'ms'}, tracefile)
+        logging.info(f'Profile saved in {self.working_path + cache_path}profile.json and trace.json')
+
+    ## Return the parsed content of the YAML file 'filename', raising
+    #  FileNotFoundError if it does not exist. Documents are kept in yaml_documents
+    #  and parsed again only if the state of the file changed, so the returned
+    #  document is shared and MUST NOT be modified.
+    def loadYAML(self, filename):
+        stat = os.stat(filename)
+        state = (stat.st_mtime_ns, stat.st_size)
+        try:
+            cached_state, document = self.yaml_documents.pop(filename)
+        except KeyError:
+            cached_state = None
+        if cached_state != state:
+            start = time.perf_counter()
+            with open(filename, 'r') as yamlfile:
+                document = yaml.load(yamlfile.read(), Loader = yaml_loader)
+            self.yaml_documents_changed = True
+            if self.parsed_yaml_files is not None:
+                self.parsed_yaml_files.add(filename)
+            if self.profile is not None:
+                self.profile['counters']['yaml_files_parsed'] += 1
+                self.profile['counters']['yaml_seconds'] += time.perf_counter() - start
+                self.profile['counters']['bytes_read'] += stat.st_size
+        self.yaml_documents[filename] = (state, document)
+        self.evictYAMLDocuments()
+        return self.yaml_documents[filename][1]
+
+    ## Evict the least recently used parsed YAML files, over yaml_cache_size
+    def evictYAMLDocuments(self):
+        while len(self.yaml_documents) > yaml_cache_size:
+            del self.yaml_documents[next(iter(self.yaml_documents))]
+
+    ## Load the parsed YAML files saved by a previous run, if yaml_documents is empty
+    def loadYAMLCache(self):
+        if self.yaml_documents:
+            return
+        try:
+            with open(self.working_path + cache_path + 'yaml.pickle', 'rb') as cachefile:
+                cache_data = pickle.load(cachefile)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return
+        if cache_data.get('version') == getSwampVersion():
+            self.yaml_documents.update(cache_data['documents'])
+            self.yaml_documents_changed = False
+
+    ## Save the parsed YAML files, if they changed, for the next run
+    def saveYAMLCache(self):
+        if not self.yaml_documents_changed:
+            return
+        os.makedirs(self.working_path + cache_path, exist_ok = True)
+        with open(self.working_path + cache_path + 'yaml.pickle.tmp', 'wb') as cachefile:
+            pickle.dump({'version': getSwampVersion(), 'documents': self.yaml_documents}, cachefile, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.working_path + cache_path + 'yaml.pickle.tmp', self.working_path + cache_path + 'yaml.pickle')
+        self.yaml_documents_changed = False
+
+    ## Load a configuaration file given the path (NB: the path DOES NOT
+    #  include filename, wich is assumed to be 'config.yaml' by default) and
+    #  stores it in config.
+    def loadConfig(self, path):
+        confdata = self.loadYAML(path + 'config.yaml')
 
         #Assert that all basics configuration are in the file
         for n in needed_global_conf:
             assert(n in confdata)
 
-        global config
-        config = confdata
-        variables.append(config)
-
-## Load the template file given the path (NB: the path DOES NOT
-#  include filename, wich is assumed to be 'template.html' by default)
-def loadTemplate(path):
-    with open(path + 'template.html', 'r') as templatefile:
-        global template
-        template = removeCommentsFromHTML(templatefile.read())
-
-## Load the variables of the directory given by path and pushes a dictionary
-#  containg them in the list of variables. If the directory does not contain
-#  variables it creates an empty dictionary.
-def loadVariables(path):
-    if not os.path.isfile(path + 'variables.yaml'):
-        variables.append({})
-        return
-    with open(path + 'variables.yaml', 'r') as varfile:
-        new_dict = yaml.safe_load(varfile.read())
+        self.config = confdata
+        pushScope(self.variables, self.config)
 
-        if new_dict is None:
-            new_dict = {}
-        variables.append(new_dict)
+    ## Load the template file given the path (NB: the path DOES NOT
+    #  include filename, wich is assumed to be 'template.html' by default)
+    def loadTemplate(self, path):
+        with open(path + 'template.html', 'r') as templatefile:
+            self.template = self.compileHTML(templatefile.read(), path + 'template.html')
 
-## Remove last element of the list variables. Since it is used as a stack
-#  it should be called after having done everything needed in a directory.
-def unloadVariables():
-    del variables[-1]
+    ## Compile a variable or locale value. Values are compiled only once in a
+    #  build, and since most of them are plain text they are kept as they are.
+    def compileValue(self, value, source, marks):
+        if '{' not in value:
+            return [value]
+        try:
+            return self.compiled_values[(value, source, marks)]
+        except KeyError:
+            self.compiled_values[(value, source, marks)] = compileTemplate(value, source, marks)
+            return self.compiled_values[(value, source, marks)]
+
+    ## Compile the HTML 'code' of the file 'source' without comments, and
+    #  minified (see minify_mode) unless 'raw' is True. The files included in
+    #  the content of <pre>, <script>, <style> and <textarea> are marked, so
+    #  that they are not minified either (see markRawFiles).
+    def compileHTML(self, code, source, raw = False):
+        if raw or self.minify_mode is None:
+            return compileTemplate(removeCommentsFromHTML(code), source)
+        raw_ranges = []
+        nodes = compileTemplate(removeCommentsFromHTML(code, self.minify_mode, raw_ranges), source)
+        return markRawFiles(nodes, raw_ranges) if raw_ranges else nodes
+
+    ## Load the variables of the directory given by path and pushes a dictionary
+    #  containg them in the list of variables. If the directory does not contain
+    #  variables it creates an empty dictionary.
+    def loadVariables(self, path):
+        try:
+            new_dict = self.loadYAML(path + 'variables.yaml')
+        except FileNotFoundError:
+            new_dict = None
 
-## Load the HTML files of the directory given by path and pushes a dictionary
-#  containg them in the list of HTML files. If the directory does not contain
-#  variables it creates an empty dictionary.
-def loadHTMLFiles(path):
-    tmp_dict = {}
+        if new_dict is None:
+            new_dict = {}
+        pushScope(self.variables, new_dict)
+
+    ## Remove last element of the list variables. Since it is used as a stack
+    #  it should be called after having done everything needed in a directory.
+    def unloadVariables(self):
+        del self.variables[-1]
+
+    ## Load the names of the HTML files of the directory given by path and pushes
+    #  a dictionary containg them in the list of HTML files. If the directory does
+    #  not contain HTML files it creates an empty dictionary. Files are read only
+    #  when they are used (see getHTMLFile).
+    def loadHTMLFiles(self, path):
+        tmp_dict = {}
+
+        for entry in os.scandir(path):
+            if entry.name.endswith('.html') and entry.is_file():
+                tmp_dict[entry.name[:-5]] = path + entry.name
+
+        pushScope(self.HTML_files, tmp_dict)
+        # A new scope for expanded files is needed only if something changed
+        if tmp_dict or not self.expanded_HTML_files:
+            self.expanded_HTML_files.append({})
+        else:
+            self.expanded_HTML_files.append(self.expanded_HTML_files[-1])
+
+    ## Load the variables, locale and HTML files of the page of a record of a
+    #  collection, as a subdirectory of the collection. 'path' is the path of
+    #  the page and 'record' the record. The fields of the record are variables,
+    #  and its field 'locale' contains locale entries. The HTML files in the field
+    #  'fragments' of 'collection.yaml' (name: file) replace the ones with the
+    #  same name.
+    def loadRecord(self, path, record):
+        directory = self.collection_pages[path][0]
+        pushScope(self.variables, {name: value for name, value in record.items() if name != 'locale'})
+
+        # The scope of HTML files is the same for every record
+        scope = self.collection_scopes.get(directory)
+        if scope is None or scope[0] is not self.HTML_files[-1]:
+            fragments = self.loadYAML(directory + 'collection.yaml').get('fragments') or {}
+            if fragments:
+                files = dict(self.HTML_files[-1])
+                files.update((name, directory + filename + '.html') for name, filename in fragments.items())
+                scope = (self.HTML_files[-1], files, {})
+            else:
+                scope = (self.HTML_files[-1], self.HTML_files[-1], self.expanded_HTML_files[-1])
+            self.collection_scopes[directory] = scope
+        self.HTML_files.append(scope[1])
+        self.expanded_HTML_files.append(scope[2])
 
-    for entry in os.scandir(path):
-        if entry.is_file and entry.name.endswith('.html'):
-            with open(path + entry.name, 'r') as filedata:
-                filedata = removeCommentsFromHTML(filedata.read())
-                tmp_dict[entry.name[:-5]] = filedata
-
-    HTML_files.append(tmp_dict)
-
-## Remove last element of the list HTML_files. Since it is used as a stack
-#  it should be called after having done everything needed in a directory.
-def unloadHTMLFiles():
-    del HTML_files[-1]
-
-def empytLocale():
-    for lang in alt_languages+[config['DEFAULT_LANGUAGE']]:
-        locale[lang].append({})
-
-def loadLocale(path):
-    if not os.path.isfile(path + 'locale.yaml'):
-        empytLocale()
-        return
-    with open(path + 'locale.yaml', 'r') as localefile:
-        # Get the locale path names
-        locale_data = yaml.safe_load(localefile.read())
+        record_locale = record.get('locale')
+        for lang in self.alt_languages+[self.config['DEFAULT_LANGUAGE']]:
+            tmp_dict = {}
+            if isinstance(record_locale, dict):
+                for locale_variable in record_locale:
+                    if locale_variable == 'path_name':
+                        continue
+                    try:
+                        tmp_dict[locale_variable] = record_locale[locale_variable][lang]
+                    except (KeyError, TypeError):
+                        pass
+            pushScope(self.locale[lang], tmp_dict)
+        self.loaded_directories.append(path)
+
+    ## Remove last element of the list HTML_files. Since it is used as a stack
+    #  it should be called after having done everything needed in a directory.
+    def unloadHTMLFiles(self):
+        del self.HTML_files[-1]
+        del self.expanded_HTML_files[-1]
+
+    def empytLocale(self):
+        for lang in self.alt_languages+[self.config['DEFAULT_LANGUAGE']]:
+            pushScope(self.locale[lang], {})
+
+    def loadLocale(self, path):
+        try:
+            locale_data = self.loadYAML(path + 'locale.yaml')
+        except FileNotFoundError:
+            locale_data = None
         if locale_data is None:
-            empytLocale()
+            self.empytLocale()
             return
-        for lang in alt_languages:
-            try:
-                alt_languages_path[lang] = makePathNormalized(alt_languages_path[lang] + makePathNormalized(locale_data['path_name'][lang]))
-            except (KeyError, TypeError):
-                alt_languages_path[lang] = makePathNormalized(alt_languages_path[lang] + makePathNormalized(getLastDirNameInPath(path[len(working_path + source_path):])))
-        # Remove (if present) path_name to not include it in locale variables
-        try:
-            del locale_data['path_name']
-        except KeyError:
-            pass
 
         # Exploring all languages (alternatives and default)
-        for lang in alt_languages+[config['DEFAULT_LANGUAGE']]:
+        for lang in self.alt_languages+[self.config['DEFAULT_LANGUAGE']]:
             tmp_dict = {}
             for locale_variable in locale_data:
+                # path_name is not included in locale variables
+                if locale_variable == 'path_name':
+                    continue
                 try:
                     tmp_dict[locale_variable] = locale_data[locale_variable][lang]
                 except KeyError:
                     pass
-            locale[lang].append(tmp_dict)
+            pushScope(self.locale[lang], tmp_dict)
 
-def unloadLocale():
-    for lang in alt_languages+[config['DEFAULT_LANGUAGE']]:
-        # Removing alt_languages_path
-        if lang != config['DEFAULT_LANGUAGE']:
-            alt_languages_path[lang] = popLastDirNameInPath(alt_languages_path[lang])
-        # Removing the locale variables
-        del locale[lang][-1]
+    def unloadLocale(self):
+        for lang in self.alt_languages+[self.config['DEFAULT_LANGUAGE']]:
+            del self.locale[lang][-1]
 
-def localizedTag(name, lang, self_tag_name = None):
-    build_local = sha256(lang.encode('utf-8')).hexdigest()
-    build_name = name
-    open_square_bracket = name.find('[')
-    close_square_bracket = name.find(']')
-    if open_square_bracket != -1 and close_square_bracket !=-1:
-        build_local = sha256(name[open_square_bracket+1:close_square_bracket].encode('utf-8')).hexdigest()
-        build_name = name[:open_square_bracket]
-    else:
-        build_name = name
-
-    # Special names
-    if name == 'static':
-        build_local = ''
-    elif build_name == 'self' and self_tag_name is not None:
-        build_name = self_tag_name
-
-    if build_name == 'self':
-        print(name, lang, self_tag_name, build_name, build_local)
+    ## Push the name of the directory given by path in each alternative language
+    #  on alt_languages_path. The names are in the field 'path_name' of
+    #  'locale.yaml'; if a name is not specified the directory name is used.
+    def loadPathNames(self, path):
+        path_names = None
+        try:
+            locale_data = self.loadYAML(path + 'locale.yaml')
+        except FileNotFoundError:
+            locale_data = None
+        if isinstance(locale_data, dict):
+            path_names = locale_data.get('path_name')
+        for lang in self.alt_languages:
+            try:
+                self.alt_languages_path[lang] = makePathNormalized(self.alt_languages_path[lang] + makePathNormalized(path_names[lang]))
+            except (KeyError, TypeError):
+                self.alt_languages_path[lang] = makePathNormalized(self.alt_languages_path[lang] + makePathNormalized(getLastDirNameInPath(path[len(self.working_path + source_path):])))
 
-    return build_name + build_local
+    ## Remove the name of the last directory from alt_languages_path.
+    def unloadPathNames(self, path = None):
+        for lang in self.alt_languages:
+            self.alt_languages_path[lang] = popLastDirNameInPath(self.alt_languages_path[lang])
 
-## Get the tag of the directory (contained in the file 'tag.yaml') and
-#  stores it in the links dictionary.
-def getPathTags(path):
-    # if tag.yaml is not present it returns random tag
-    if not os.path.isfile(path + 'tag.yaml'):
-        return sha256(path.encode('utf-8')).hexdigest()
-    with open(path + 'tag.yaml', 'r') as tagfile:
-        tagdata = yaml.safe_load(tagfile.read())
-        if path.startswith(working_path):
-            links[localizedTag(tagdata['tag'], config['DEFAULT_LANGUAGE'])] = (makePathEndWithSlash(config['DEFAULT_LANGUAGE']) if subdirectory_default_language else '') + path[len(working_path + source_path):]
-        for lang in alt_languages:
-            links[localizedTag(tagdata['tag'], lang)] = makePathNormalized(lang) + alt_languages_path[lang]
+    ## Get the tag of the directory (contained in the file 'tag.yaml').
+    def getPathTags(self, path):
+        # if tag.yaml is not present it returns random tag
+        try:
+            tagdata = self.loadYAML(path + 'tag.yaml')
+        except FileNotFoundError:
+            return sha256(path.encode('utf-8')).hexdigest()
         return tagdata['tag']
 
+    ## Compute the path of the page of the directory 'path' in every language and
+    #  stores it in the pages and links dictionaries. It is called before building
+    #  any page, so that all links can be resolved while pages are built.
+    def registerDirectory(self, path):
+        self.loadPathNames(path)
+        tag = self.getPathTags(path)
+
+        page_paths = {self.config['DEFAULT_LANGUAGE']: (makePathEndWithSlash(self.config['DEFAULT_LANGUAGE']) if self.subdirectory_default_language else '') + path[len(self.working_path + source_path):]}
+        for lang in self.alt_languages:
+            page_paths[lang] = makePathNormalized(lang) + self.alt_languages_path[lang]
+
+        for lang in page_paths:
+            self.links[localizedTag(tag, lang)] = page_paths[lang]
+        self.pages[path] = (tag, page_paths)
+
+        if os.path.isfile(path + 'collection.yaml'):
+            self.registerCollection(path)
+
+    ## Return the records of the data file of the collection in the directory
+    #  'path', one at a time, so that the file is never loaded at once. The data
+    #  file is a CSV file with a header, a JSON Lines file (one object for each
+    #  line) or a YAML file, whose documents are records or lists of records.
+    def readCollection(self, path):
+        filename = path + self.loadYAML(path + 'collection.yaml')['data']
+        extension = os.path.splitext(filename)[1].lower()
+        with open(filename, 'r', newline = '' if extension == '.csv' else None) as datafile:
+            if extension == '.csv':
+                yield from csv.DictReader(datafile)
+            elif extension in ('.jsonl', '.ndjson'):
+                for line in datafile:
+                    if line.strip():
+                        yield json.loads(line)
+            elif extension in ('.yaml', '.yml'):
+                for document in yaml.load_all(datafile, Loader = yaml_loader):
+                    if isinstance(document, list):
+                        yield from document
+                    elif document is not None:
+                        yield document
+            else:
+                raise ValueError(f'{filename}: unknown format of collection data')
+
+    ## Compute the path of the page of each record of the collection in the
+    #  directory 'path' and stores it in the pages and links dictionaries, as
+    #  registerDirectory does for a subdirectory. The name of the page is the
+    #  field 'path_name' of 'collection.yaml' of the record (default 'name') and
+    #  its tag the field 'tag' (default 'tag'). The field 'locale' of a record
+    #  can contain locale entries, as 'locale.yaml', also 'path_name'.
+    def registerCollection(self, path):
+        settings = self.loadYAML(path + 'collection.yaml')
+        name_field = settings.get('path_name', 'name')
+        tag_field = settings.get('tag', 'tag')
+        record_paths = []
+        for index, record in enumerate(self.readCollection(path)):
+            try:
+                name = str(record[name_field])
+            except KeyError:
+                raise KeyError(f'{path}collection.yaml: record {index} without field "{name_field}"')
+            # The page must be in the directory of the collection
+            if not isValidPathName(name):
+                raise ValueError(f'{path}collection.yaml: record {index} has the invalid path name "{name}"')
+            name = makePathNormalized(name)
+            record_path = path + name
+            if tag_field in record:
+                tag = str(record[tag_field])
+            else:
+                tag = sha256(record_path.encode('utf-8')).hexdigest()
 
-## Return the actual value of the variable 'name'. "Actual" means the last
-#  inserted occurence of the variable 'name' in variables list.
-def getVariablesValue(name):
-    for dictionary in reversed(variables):
-        if name in dictionary:
-            return dictionary[name]
-    # TODO: Raise an error if not found!
-
-
-## Return the actual contenent of the file 'name'. "Actual" means the last
-#  inserted occurence of file 'name' in HTML_files list.
-def getHTMLFile(name):
-    for dictionary in reversed(HTML_files):
-        if name in dictionary:
-            return dictionary[name]
-    # TODO: Raise an error if not found!
-
-## Seek for an expression in the strong code. If found it returns a string
-#  containing its name, otherwise it returns None. Expression are in the
-#  form: " [code] {'mark' name_of_expression 'mark'}
-def expressionGetter(code, mark):
-    start_index = code.find('{' + mark)
-    if start_index == -1:
-        return None
+            page_paths = {self.config['DEFAULT_LANGUAGE']: (makePathEndWithSlash(self.config['DEFAULT_LANGUAGE']) if self.subdirectory_default_language else '') + record_path[len(self.working_path + source_path):]}
+            record_locale = record.get('locale')
+            for lang in self.alt_languages:
+                try:
+                    localized_name = str(record_locale['path_name'][lang])
+                except (KeyError, TypeError):
+                    localized_name = None
+                if localized_name is None:
+                    page_paths[lang] = makePathNormalized(lang) + self.alt_languages_path[lang] + name
+                elif not isValidPathName(localized_name):
+                    raise ValueError(f'{path}collection.yaml: record {index} has the invalid path name "{localized_name}" ({lang})')
+                else:
+                    page_paths[lang] = makePathNormalized(lang) + self.alt_languages_path[lang] + makePathNormalized(localized_name)
+
+            for lang in page_paths:
+                self.links[localizedTag(tag, lang)] = page_paths[lang]
+            self.pages[record_path] = (tag, page_paths)
+            digest = sha256(json.dumps(record, sort_keys = True, default = str).encode('utf-8')).hexdigest()
+            self.collection_pages[record_path] = (path, index, digest)
+            record_paths.append(record_path)
+        self.collection_paths[path] = record_paths
+
+
+    ## Return the actual value of the variable 'name'. "Actual" means the last
+    #  inserted occurence of the variable 'name' in variables list.
+    #  It raises KeyError if the variable is not defined.
+    def getVariablesValue(self, name):
+        return self.variables[-1][name]
+
+
+    ## Return the list of directories from source_path to 'path' (included).
+    #  Example: "./website/some/dire/" --> ["./website/", "./website/some/", "./website/some/dire/"]
+    def getSourceAncestors(self, path):
+        ancestors = [self.working_path + source_path]
+        for name in path[len(self.working_path + source_path):].split('/')[:-1]:
+            ancestors.append(ancestors[-1] + name + '/')
+        return ancestors
+
+    ## Return the files read to build the page of the directory 'path'. The files
+    #  are the ones of the same stack used during the DFS, also the ones that do
+    #  not exist: creating them changes the page. 'file_names' are the names of
+    #  the HTML files used by the page.
+    def getDependencies(self, path, file_names):
+        files = {self.working_path + 'template.html',
+                 self.working_path + 'config.yaml',
+                 self.working_path + 'variables.yaml',
+                 self.working_path + 'locale.yaml',
+                 path + 'tag.yaml'}
+        for directory in self.getSourceAncestors(path):
+            files.add(directory + 'variables.yaml')
+            files.add(directory + 'locale.yaml')
+            for name in file_names:
+                files.add(directory + name + '.html')
+        # The record of a page of a collection is compared by its digest
+        if path in self.collection_pages:
+            directory = self.collection_pages[path][0]
+            files.add(directory + 'collection.yaml')
+            fragments = self.loadYAML(directory + 'collection.yaml').get('fragments') or {}
+            files.update(directory + filename + '.html' for filename in fragments.values())
+        return files
+
+    ## Store the files read to build the page of the directory 'path' and the
+    #  tags of its links.
+    def recordDependencies(self, path, file_names):
+        files = self.getDependencies(path, file_names)
+        for filename in files:
+            if filename not in self.file_states:
+                self.file_states[filename] = fileState(filename)
+        self.dependencies[path] = (frozenset(files), frozenset(self.rendered_links))
+
+    ## Load the build cache of the previous build. If it is missing or it was
+    #  made by another version of swamp it returns None.
+    def loadBuildCache(self):
+        try:
+            with open(self.working_path + cache_path + 'build.json', 'r') as cachefile:
+                cache_data = json.load(cachefile)
+        except (FileNotFoundError, ValueError):
+            return None
+        if cache_data.get('version') != getSwampVersion():
+            return None
+        return cache_data
+
+    ## Save the build cache, so that the next build can skip the unchanged pages
+    def saveBuildCache(self):
+        os.makedirs(self.working_path + cache_path, exist_ok = True)
+        self.build_cache['version'] = getSwampVersion()
+        with open(self.working_path + cache_path + 'build.json.tmp', 'w') as cachefile:
+            json.dump(self.build_cache, cachefile)
+        os.replace(self.working_path + cache_path + 'build.json.tmp', self.working_path + cache_path + 'build.json')
+
+    ## Return the SHA-256 of the content of a file, or None if it does not exist.
+    #  The digest in the build cache is used if the state of the file did not change.
+    def fileDigest(self, filename):
+        if filename in self.file_digests:
+            return self.file_digests[filename]
+        state = fileState(filename)
+        if state is None:
+            digest = None
+        else:
+            cached_file = self.build_cache['files'].get(filename)
+            if cached_file is not None and (cached_file[0], cached_file[1]) == state:
+                digest = cached_file[2]
+            else:
+                start = time.perf_counter()
+                with open(filename, 'rb') as datafile:
+                    digest = sha256(datafile.read()).hexdigest()
+                self.build_cache['files'][filename] = [state[0], state[1], digest]
+                if self.profile is not None:
+                    self.profile['counters']['checksum_files'] += 1
+                    self.profile['counters']['checksum_seconds'] += time.perf_counter() - start
+        self.file_digests[filename] = digest
+        return digest
+
+    ## Return the key of the page of the directory 'path' in the build cache. It
+    #  depends on the content of the files read to build it, on its path in every
+    #  language and on the targets of its links.
+    def getPageCacheKey(self, path, file_names, tags):
+        key_data = [self.minify_mode, self.precompress_encodings, self.pages[path][0], sorted(self.pages[path][1].items()),
+                    self.collection_pages[path][2] if path in self.collection_pages else None,
+                    sorted((filename, self.fileDigest(filename)) for filename in self.getDependencies(path, file_names)),
+                    sorted((tag, self.links.get(tag)) for tag in tags)]
+        return sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+    ## Return True if the page of the directory 'path' in public_path is the same
+    #  that would be built now. Pages using the timestamp are always built again,
+    #  as the ones with links to unknown tags, so that they are reported.
+    def isPageCached(self, path):
+        cached_page = self.build_cache['pages'].get(path)
+        if cached_page is None or cached_page['timestamp']:
+            return False
+        if any(tag not in self.links for tag in cached_page['tags']):
+            return False
+        if any(not os.path.isfile(self.working_path + self.output_path + page_path + 'index.html') for page_path in self.pages[path][1].values()):
+            return False
+        if self.getPageCacheKey(path, cached_page['files'], cached_page['tags']) != cached_page['key']:
+            return False
+        if self.search_index is not None and path not in self.search_index.pages:
+            return False
+
+        self.rendered_links.clear()
+        self.rendered_links.update(cached_page['tags'])
+        self.recordDependencies(path, cached_page['files'])
+        return True
+
+    ## Store the page of the directory 'path', just built, in the build cache
+    def storePageInCache(self, path, file_names):
+        self.build_cache['pages'][path] = {
+            'key': self.getPageCacheKey(path, file_names, self.rendered_links),
+            'tag': self.pages[path][0],
+            'paths': self.pages[path][1],
+            'files': sorted(file_names),
+            'tags': sorted(self.rendered_links),
+            'timestamp': self.rendered_timestamp
+        }
+
+    ## Return the set of directories whose page must be rebuilt, given the files
+    #  that changed and the links table, the pages and the pages of collections
+    #  of the previous build.
+    def getAffectedPages(self, changed_files, old_links, old_pages, old_collection_pages):
+        changed_tags = {tag for tag in old_links.keys() | self.links.keys() if old_links.get(tag) != self.links.get(tag)}
+        affected = set()
+        for path in self.pages:
+            if path not in self.dependencies or old_pages.get(path) != self.pages[path]:
+                affected.add(path)
+                continue
+            if path in self.collection_pages and \
+               (path not in old_collection_pages or old_collection_pages[path][2] != self.collection_pages[path][2]):
+                affected.add(path)
+                continue
+            files, tags = self.dependencies[path]
+            if not files.isdisjoint(changed_files) or not tags.isdisjoint(changed_tags):
+                affected.add(path)
+        return affected
+
+    ## Remove the pages of the previous build that are no longer generated,
+    #  because their directory was removed or renamed in some language.
+    def removeStalePages(self, old_pages):
+        page_paths = {page_path for tag, paths in self.pages.values() for page_path in paths.values()}
+        stale_paths = set()
+        for path in old_pages:
+            if path not in self.pages:
+                self.dependencies.pop(path, None)
+            stale_paths.update(old_pages[path][1].values())
+        stale_paths -= page_paths
+
+        for page_path in stale_paths:
+            logging.debug(f'Removing {page_path}')
+            for filename in ['index.html'] + ['index.html.' + encoding for encoding in ('gz', 'br')]:
+                try:
+                    os.remove(self.working_path + self.output_path + page_path + filename)
+                except FileNotFoundError:
+                    pass
+        # Deepest directories first, so that the parents can become empty
+        for page_path in sorted(stale_paths, key = len, reverse = True):
+            try:
+                os.rmdir(self.working_path + self.output_path + page_path)
+            except OSError:
+                pass
+
+    ## Return the state of all files in the static directory
+    def staticFilesState(self):
+        state = {}
+        for dirpath, dirnames, filenames in os.walk(self.working_path + static_path):
+            for filename in filenames:
+                state[os.path.join(dirpath, filename)] = fileState(os.path.join(dirpath, filename))
+        return state
+
+    ## Return the actual contenent of the file 'name', compiled. "Actual" means
+    #  the last inserted occurence of file 'name' in HTML_files list.
+    #  It returns None if the file is not defined. Each file is read and compiled
+    #  only once in a build, the first time it is used. If 'raw' is True the
+    #  file is not minified (see compileHTML).
+    def getHTMLFile(self, name, raw = False):
+        filename = self.HTML_files[-1].get(name) if self.HTML_files else None
+        if filename is None:
+            return None
+        try:
+            return self.compiled_HTML_files[(filename, raw)]
+        except KeyError:
+            pass
 
-    end_index = code.find(mark + '}')
-    if end_index == -1:
-        #TODO: Raise something wich will work...
-        raise VariableError('Missing end of variable')
-    return code[start_index + 2:end_index]
+        with open(filename, 'r') as filedata:
+            code = filedata.read()
+        self.compiled_HTML_files[(filename, raw)] = self.compileHTML(code, filename, raw)
+        if self.profile is not None:
+            self.profile['counters']['html_files_read'] += 1
+            self.profile['counters']['bytes_read'] += len(code)
+        return self.compiled_HTML_files[(filename, raw)]
+
+    ## Replace all expression identifying a file HTML with corrispondent compiled
+    #  code. The expansion of each file is memoized in the actual scope.
+    #  The names of all the files used are added to the set 'used'. If 'raw' is
+    #  True the nodes are in an element that is not minified, and so are the
+    #  files they include.
+    def expandHTMLFiles(self, nodes, used, including = (), raw = False):
+        expanded = []
+        for node in nodes:
+            if isinstance(node, str):
+                expanded.append(node)
+            elif node[0] == '#':
+                expanded_file, file_names = self.getExpandedHTMLFile(node, including, raw or node[2] is True)
+                expanded.extend(expanded_file)
+                used.update(file_names)
+            elif node[0] == '%':
+                expanded.append((node[0], node[1], self.expandHTMLFiles(node[2], used, including, raw), node[3], node[4]))
+            else:
+                expanded.append(node)
+        return expanded
+
+    ## Return the compiled code of the file referred by 'node' with all the file
+    #  expressions replaced, and the set of names of the files it uses.
+    #  'including' are the files that are being expanded, used to detect
+    #  recursive inclusions. If 'raw' is True the file is not minified.
+    def getExpandedHTMLFile(self, node, including, raw = False):
+        name = node[1]
+        expanded_files = self.expanded_HTML_files[-1]
+        if (name, raw) in expanded_files:
+            return expanded_files[(name, raw)]
+        if name in including:
+            raise TemplateError(f'{node[3]}, offset {node[4]}: file "{name}" includes itself')
+
+        compiled_file = self.getHTMLFile(name, raw)
+        if compiled_file is None:
+            raise TemplateError(f'{node[3]}, offset {node[4]}: unknown HTML file "{name}"')
+        start = time.perf_counter() if self.profile is not None else None
+        used = {name}
+        expanded_files[(name, raw)] = (self.expandHTMLFiles(compiled_file, used, including + (name,), raw), frozenset(used))
+        if self.profile is not None:
+            self.profile['counters']['fragments_expanded'] += 1
+            self.profileEvent('fragment', name, start, {'directory': self.loaded_directories[-1] if self.loaded_directories else self.working_path})
+        return expanded_files[(name, raw)]
+
+    ## Insert the variables in the compiled code, appending to the list 'output'
+    #  the plain code, the locale expressions (whose default is turned into a
+    #  skeleton too) and the links.
+    def insertVariables(self, nodes, output, depth):
+        if depth > max_expression_depth:
+            raise TemplateError('Too many nested expressions: probably a variable contains itself')
+        for node in nodes:
+            if isinstance(node, str):
+                output.append(node)
+                continue
 
-## Replace all expression identifying a file HTML with corrispondent HTML
-#  code.
-def insertHTMLFiles(code):
-    while True:
-        name = expressionGetter(code, '#')
-        if name is None:
-            break
-        # It replaces all occurence, not only the first one, but obiouvsly
-        # it isn't a problem.
-        code = code.replace('{#' + name + '#}', getHTMLFile(name), 1)
-    return code
-
-## Replace all expression identifying a variable with corrispondent actual
-#  value.
-def insertVariables(code):
-    while True:
-        name = expressionGetter(code, '$')
-        if name is None:
-            break
-        # It replaces all occurence, not only the first one, but obiouvsly
-        # it isn't a problem.
-        code = code.replace('{$' + name + '$}', str(getVariablesValue(name)), 1)
-    return code
-
-## Save the 'code' in a file named 'index.html' stored in the directory
-#  'path' relative to the public_path.
-def pushPath(path, code):
-    filename = working_path + public_path + path + 'index.html'
-    os.makedirs(os.path.dirname(filename), exist_ok = True)
-    with open(filename, "w+") as destination_file:
-        logging.debug('Created {0}'.format(filename))
-        destination_file.write(code)
-
-def getLocale(lang, name):
-    for dictionary in reversed(locale[lang]):
-        if name in dictionary:
-            return dictionary[name]
-
-## It substitute the tag names for links with a localized version, to correctly map
-#  different language pages
-def rebuildLinksWithLocale(code, lang, self_tag_name):
-    if lang not in alt_languages + [config['DEFAULT_LANGUAGE']]:
-        raise ValueError(f'{lang} not in the list of alternatives languages: {alt_languages}, and not default language.')
-    while True:
-       name = expressionGetter(code, '_')
-       if name is None:
-           break
-       code = code.replace('{_' + name + '_}', '{-_' + (name if name=='static' else localizedTag(name,lang,self_tag_name)) + '_-}', 1)
-    code = code.replace('{-_', '{_')
-    code = code.replace('_-}', '_}')
-    return code
-
-def insertLocale(code, lang):
-    while True:
-        content = expressionGetter(code, '%')
-        if content is None:
-            break
-        variable_name = content[content.find('(')+1:content.find(')')]
-        variable_value = content[content.find(')')+1:]
-        # It replaces all occurence, not only the first one, but obiouvsly
-        # it isn't a problem.
-        to_insert = getLocale(lang, variable_name)
-        if to_insert is None:
-            to_insert = variable_value
-        code = code.replace('{%('+ variable_name + ')' + variable_value + '%}', to_insert, 1)
-    return code
-
-## Given a directory 'path' loads all the data, insert all the expression
-#  and push the new file to public_dir
-def processDirectory(path):
-    logging.debug('Working on {0}'.format(path))
-
-    # Get info of this dir
-    loadVariables(path)
-    loadHTMLFiles(path)
-    loadLocale(path)
-    self_tag_name = getPathTags(path)
-
-    logging.debug(alt_languages_path)
-
-    processed_variables_file = insertVariables(insertHTMLFiles(template))
-
-    localized_default_language = rebuildLinksWithLocale(
-        insertLocale(processed_variables_file, config['DEFAULT_LANGUAGE']),
-        config['DEFAULT_LANGUAGE'],
-        self_tag_name
-    )
-
-    # Default language
-    pushPath(path.replace(working_path + source_path,
-                          makePathEndWithSlash(config['DEFAULT_LANGUAGE']) if subdirectory_default_language else ''),
-             localized_default_language)
-
-    # Alternatives
-    for alt_lang in alt_languages:
-        pushPath(makePathNormalized(alt_lang) + alt_languages_path[alt_lang],
-                 rebuildLinksWithLocale(insertLocale(processed_variables_file, alt_lang), alt_lang, self_tag_name))
-
-## Removes variables and HTML files from respective lists.
-def releaseDirectory(path):
-    unloadHTMLFiles()
-    unloadVariables()
-    unloadLocale()
-
-## Given a public path replace all link expression with the correct
-#  hyperlink (using the location config)
-def buildLinks(path):
-    with open(path + 'index.html', "r") as codefile:
-        code = codefile.read()
+            mark, name = node[0], node[1]
+            if self.profile is not None:
+                self.profile['counters']['expressions ' + mark] += 1
+            if mark == '$':
+                if name == 'timestamp':
+                    self.rendered_timestamp = True
+                try:
+                    value = self.getVariablesValue(name)
+                except KeyError:
+                    key = ('{$' + name + '$}', node[3], node[4])
+                    self.undefined_variables.setdefault(key, set()).add(self.loaded_directories[-1] if self.loaded_directories else self.working_path)
+                    value = None
+                self.insertVariables(self.compileValue(str(value), f'variable {name}', '$%_'), output, depth + 1)
+            elif mark == '%':
+                output.append((mark, name, self.renderSkeleton(node[2], depth + 1), node[3], node[4]))
+            elif mark == '_':
+                output.append(node)
+            else:
+                raise TemplateError(f'{node[3]}, offset {node[4]}: unexpected expression "{{{mark}"')
+
+    ## Return the skeleton of the compiled code: the variables are the same in
+    #  every language, so they are inserted only once for all of them. The
+    #  skeleton is a tuple (parts, slots): 'parts' is a list of plain code and
+    #  'slots' a list of tuples (index, node) with the locale expressions and the
+    #  links, whose element of 'parts' is filled in each language by fillSkeleton.
+    def renderSkeleton(self, nodes, depth = 0):
+        resolved = []
+        self.insertVariables(nodes, resolved, depth)
+        parts = []
+        slots = []
+        plain = []
+        for node in resolved:
+            if isinstance(node, str):
+                plain.append(node)
+            else:
+                parts.append(''.join(plain))
+                plain = []
+                slots.append((len(parts), node))
+                parts.append(None)
+        parts.append(''.join(plain))
+        return parts, slots
+
+    ## Return the code of the skeleton in the language 'lang'
+    def fillSkeleton(self, skeleton, lang, self_tag_name, depth = 0):
+        parts, slots = skeleton
+        parts = parts.copy()
+        if self.profile is not None:
+            self.profile['counters']['slots filled'] += len(slots)
+        for index, node in slots:
+            if node[0] == '_':
+                parts[index] = self.renderLink(node, lang, self_tag_name)
+                continue
+            to_insert = self.getLocale(lang, node[1])
+            if to_insert is None:
+                parts[index] = self.fillSkeleton(node[2], lang, self_tag_name, depth + 1)
+            else:
+                output = []
+                self.renderTemplate(self.compileValue(str(to_insert), f'locale {node[1]}', '%_'),
+                                    lang, self_tag_name, output, depth + 1)
+                parts[index] = ''.join(output)
+        return ''.join(parts)
+
+    ## Render the compiled locale value in the language 'lang': locale strings are
+    #  inserted and links are rendered (see renderLink). The result is appended
+    #  to the list of strings 'output'.
+    def renderTemplate(self, nodes, lang, self_tag_name, output, depth = 0):
+        if depth > max_expression_depth:
+            raise TemplateError(f'Too many nested expressions while rendering {lang}: probably a value contains itself')
+        for node in nodes:
+            if isinstance(node, str):
+                output.append(node)
+                continue
 
-    while True:
-        tag = expressionGetter(code, '_')
-        if tag is None:
-            break
+            mark, name = node[0], node[1]
+            if self.profile is not None:
+                self.profile['counters']['expressions ' + mark] += 1
+            if mark == '%':
+                to_insert = self.getLocale(lang, name)
+                if to_insert is None:
+                    self.renderTemplate(node[2], lang, self_tag_name, output, depth + 1)
+                else:
+                    self.renderTemplate(self.compileValue(str(to_insert), f'locale {name}', '%_'),
+                                        lang, self_tag_name, output, depth + 1)
+            elif mark == '_':
+                output.append(self.renderLink(node, lang, self_tag_name))
+            else:
+                raise TemplateError(f'{node[3]}, offset {node[4]}: unexpected expression "{{{mark}"')
+
+    ## Return the hyperlink of the link 'node' to the page in the language 'lang'
+    #  (or the one specified in the link). Links to unknown tags are left as they
+    #  are and stored in dangling_links.
+    def renderLink(self, node, lang, self_tag_name):
+        name = node[1]
+        kind = name.partition(':')[0]
+        if kind == 'static' or (':' in name and kind.split('-')[0] == 'srcset'):
+            tag = name
+        else:
+            tag = localizedTag(name, lang, self_tag_name)
+        self.rendered_links.add(tag)
         try:
-            code = code.replace( '{_' + tag + '_}', config['LOCATION'] + links[tag])
+            target = self.links[tag]
+            # Sources of an image with their widths
+            if isinstance(target, list):
+                return ', '.join(self.config['LOCATION'] + path + (f' {width}w' if width is not None else '')
+                                 for path, width in target)
+            return self.config['LOCATION'] + target
         except KeyError:
-            raise KeyError(f'Error while replacing {tag} in {path}')
+            key = ('{_' + name + '_}', lang, node[3], node[4])
+            self.dangling_links[key] = self.dangling_links.get(key, 0) + 1
+            return '{_' + name + '_}'
+
+    ## Return the code of the page in the language 'lang', given its skeleton
+    def renderPage(self, skeleton, lang, self_tag_name):
+        if lang not in self.alt_languages + [self.config['DEFAULT_LANGUAGE']]:
+            raise ValueError(f'{lang} not in the list of alternatives languages: {self.alt_languages}, and not default language.')
+        return self.fillSkeleton(skeleton, lang, self_tag_name)
+
+    ## Save the 'code' in a file named 'index.html' stored in the directory
+    #  'path' relative to the public_path. It is written by the page_writer, if
+    #  any, otherwise at once.
+    def pushPath(self, path, code):
+        filename = self.working_path + self.output_path + path + 'index.html'
+        data = code.encode('utf-8')
+        if self.page_writer is not None:
+            self.page_writer.write(filename, data)
+        else:
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+            writePage(filename, data, self.precompress_encodings)
+        if self.profile is not None:
+            self.profile['counters']['pages_written'] += 1
+            self.profile['counters']['bytes_written'] += len(data)
+
+        if self.pushed_pages is not None:
+            self.pushed_pages[path] = sha256(data).hexdigest()
+            if self.memory_pages is not None:
+                self.memory_pages.stage(path, data)
+
+    ## Return the actual value of the locale entry 'name' in the language 'lang',
+    #  or None if it is not defined.
+    def getLocale(self, lang, name):
+        return self.locale[lang][-1].get(name)
+
+    ## Given a directory 'path' loads all the data, insert all the expression
+    #  and push the new file to public_dir
+    def processDirectory(self, path):
+        self.loadDirectory(path)
+
+        # In incremental builds only the affected pages are built
+        if self.pages_to_build is None or path in self.pages_to_build:
+            self.buildPage(path)
+        if path in self.collection_paths:
+            self.processCollection(path)
+
+    ## Build the pages of the records of the collection in the directory 'path',
+    #  reading one record at a time. The data of 'path' must be loaded.
+    def processCollection(self, path):
+        record_paths = self.collection_paths[path]
+        if self.pages_to_build is not None and self.pages_to_build.isdisjoint(record_paths):
+            return
+        for record_path, record in zip(record_paths, self.readCollection(path)):
+            if self.pages_to_build is None or record_path in self.pages_to_build:
+                self.loadRecord(record_path, record)
+                self.buildPage(record_path)
+                self.releaseDirectory(record_path)
+
+    ## Load variables, HTML files and locale of the directory 'path'
+    def loadDirectory(self, path):
+        logging.debug('Working on {0}'.format(path))
+        self.loadVariables(path)
+        self.loadHTMLFiles(path)
+        self.loadLocale(path)
+        self.loaded_directories.append(path)
+
+    ## Insert all the expression in the template for the directory 'path' and
+    #  push the pages to public_dir. The data of 'path' and of all its parents
+    #  must be loaded.
+    def buildPage(self, path):
+        self.checkCancelled()
+        self_tag_name, page_paths = self.pages[path]
+
+        start = time.perf_counter() if self.profile is not None else None
+        if self.build_cache is not None and self.isPageCached(path):
+            logging.debug(f'Not changed {path}')
+            if self.profile is not None:
+                self.profile['counters']['pages_cached'] += 1
+            return
 
-    with open(path + 'index.html', "w") as codefile:
-        codefile.write(code)
+        # The template is expanded only once for all directories sharing the same files
+        expanded_files = self.expanded_HTML_files[-1]
+        if None not in expanded_files:
+            used = set()
+            expanded_files[None] = (self.expandHTMLFiles(self.template, used), frozenset(used))
+        expanded_template, file_names = expanded_files[None]
+
+        # Default language and alternatives
+        self.rendered_links.clear()
+        self.rendered_timestamp = False
+        skeleton = self.renderSkeleton(expanded_template)
+        documents = {}
+        for lang in [self.config['DEFAULT_LANGUAGE']] + self.alt_languages:
+            code = self.renderPage(skeleton, lang, self_tag_name)
+            self.pushPath(page_paths[lang], code)
+            # The meta language only describes the locale
+            if self.search_index is not None and lang != 'meta':
+                documents[lang] = (page_paths[lang],) + extractSearchDocument(code)
+        if self.search_index is not None:
+            self.indexed_pages[path] = documents
+
+        self.recordDependencies(path, file_names)
+        if self.build_cache is not None:
+            self.storePageInCache(path, file_names)
+        if self.profile is not None:
+            self.profile['pages'][path] = self.profileEvent('page', path, start)
+
+    ## Removes variables and HTML files from respective lists.
+    def releaseDirectory(self, path):
+        self.loaded_directories.pop()
+        self.unloadHTMLFiles()
+        self.unloadVariables()
+        self.unloadLocale()
+
+    ## Build the pages of the directories in 'paths' in a worker process. Paths
+    #  are in DFS order, so moving from a page to the next one only the
+    #  directories that differ are released and loaded. It returns a dictionary
+    #  with the dangling links, the undefined variables, the dependencies, the
+    #  states of the files read, the entries of the pages and of the files used
+    #  in the build cache, the YAML files parsed, the pages written, the
+    #  documents of the search index and the profile.
+    def buildPagesInWorker(self, paths):
+        self.dangling_links.clear()
+        self.undefined_variables.clear()
+        if self.profile is not None:
+            self.profile['events'] = []
+            self.profile['pages'] = {}
+            self.profile['counters'] = collections.Counter()
+        self.dependencies.clear()
+        # Pages are kept in memory only by the main process
+        self.memory_pages = None
+        if self.pushed_pages is not None:
+            self.pushed_pages.clear()
+        self.indexed_pages = {}
+        self.parsed_yaml_files = set()
+        self.page_writer = PageWriter(page_writer_threads, page_writer_queue_depth, self.precompress_encodings)
+
+        # Records of a collection are read in order: [directory, index of the next record, records]
+        reader = None
+        for path in paths:
+            collection = self.collection_pages.get(path)
+            ancestors = self.getSourceAncestors(path if collection is None else collection[0])
+            while len(self.loaded_directories) > len(ancestors) or \
+                  (self.loaded_directories and self.loaded_directories[-1] != ancestors[len(self.loaded_directories) - 1]):
+                self.releaseDirectory(self.loaded_directories[-1])
+            for ancestor in ancestors[len(self.loaded_directories):]:
+                self.loadDirectory(ancestor)
+            if collection is not None:
+                directory, index, digest = collection
+                if reader is None or reader[0] != directory or reader[1] > index:
+                    reader = [directory, 0, self.readCollection(directory)]
+                record = next(itertools.islice(reader[2], index - reader[1], None))
+                reader[1] = index + 1
+                self.loadRecord(path, record)
+            self.buildPage(path)
+
+        while self.loaded_directories:
+            self.releaseDirectory(self.loaded_directories[-1])
+        self.page_writer.close()
+        self.page_writer = None
+
+        states = {filename: self.file_states[filename] for files, tags in self.dependencies.values() for filename in files}
+        cached_pages = None
+        cached_files = None
+        if self.build_cache is not None:
+            cached_pages = {path: self.build_cache['pages'][path] for path in paths if path in self.build_cache['pages']}
+            # The digests of the files, also the ones computed by this process
+            cached_files = {filename: self.build_cache['files'][filename] for filename in self.file_digests if filename in self.build_cache['files']}
+        return {'dangling_links': dict(self.dangling_links),
+                'undefined_variables': dict(self.undefined_variables),
+                'dependencies': dict(self.dependencies),
+                'file_states': states,
+                'cached_pages': cached_pages,
+                'cached_files': cached_files,
+                'yaml_documents': {filename: self.yaml_documents[filename] for filename in self.parsed_yaml_files if filename in self.yaml_documents},
+                'pushed_pages': self.pushed_pages,
+                'indexed_pages': self.indexed_pages,
+                'profile': self.profile}
+
+    ## Build the pages of the directories in 'paths' with 'jobs' processes. The
+    #  workers are forked after the first pass, so they share configuration,
+    #  template, root variables and the table of links of this process.
+    def buildPagesInParallel(self, paths, jobs):
+        if not paths:
+            return
+        chunk_size = max(1, -(-len(paths) // (jobs * 4)))
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, mp_context = context,
+                                                    initializer = initializeWorker, initargs = (self,)) as executor:
+            futures = [executor.submit(buildPagesInWorker, paths[i:i + chunk_size]) for i in range(0, len(paths), chunk_size)]
+            for future in futures:
+                # The chunks not started are cancelled, the running ones completed
+                if self.cancelled.is_set():
+                    for chunk_future in futures:
+                        chunk_future.cancel()
+                    self.checkCancelled()
+                result = future.result()
+                for key, count in result['dangling_links'].items():
+                    self.dangling_links[key] = self.dangling_links.get(key, 0) + count
+                for key, directories in result['undefined_variables'].items():
+                    self.undefined_variables.setdefault(key, set()).update(directories)
+                self.dependencies.update(result['dependencies'])
+                for filename, state in result['file_states'].items():
+                    self.file_states.setdefault(filename, state)
+                if result['cached_pages'] is not None:
+                    self.build_cache['pages'].update(result['cached_pages'])
+                    self.build_cache['files'].update(result['cached_files'])
+                if result['pushed_pages'] is not None:
+                    self.pushed_pages.update(result['pushed_pages'])
+                self.indexed_pages.update(result['indexed_pages'])
+                if result['yaml_documents']:
+                    self.yaml_documents.update(result['yaml_documents'])
+                    self.yaml_documents_changed = True
+                    self.evictYAMLDocuments()
+                if result['profile'] is not None:
+                    self.profile['events'].extend(result['profile']['events'])
+                    self.profile['pages'].update(result['profile']['pages'])
+                    self.profile['counters'].update(result['profile']['counters'])
+
+    ## Return a dictionary of the static files to be published: each key is the
+    #  path relative to the static directory and its value the path of the file.
+    #  If listfilename is given, only the files and directories listed in it are
+    #  included. Each line can also be a glob pattern ('**' matches any number
+    #  of subdirectories).
+    def getStaticFiles(self, listfilename = None):
+        static_directory = self.working_path + static_path
+        if listfilename is None:
+            elementnames = ['']
+        else:
+            with open(listfilename) as staticfiles:
+                elementnames = [line.rstrip('\n').lstrip('/') for line in staticfiles if line.strip()]
+
+        files = {}
+        for elementname in elementnames:
+            if glob.has_magic(elementname):
+                matches = glob.glob(static_directory + elementname, recursive = True)
+            elif os.path.exists(static_directory + elementname):
+                matches = [static_directory + elementname]
+            else:
+                matches = []
+            if not matches:
+                logging.error("Unknown static file or directory: {}".format(elementname))
 
-def staticFilesFromList(listfilename):
-    with open(listfilename) as staticfiles:
-        for elementname in staticfiles:
-            elementname = elementname[:-1] # remove the ending newline
-            if os.path.isdir(working_path + static_path + elementname):
+            for match in matches:
+                if os.path.isdir(match):
+                    for dirpath, dirnames, filenames in os.walk(match):
+                        for filename in filenames:
+                            filepath = os.path.join(dirpath, filename)
+                            files[os.path.relpath(filepath, static_directory).replace(os.sep, '/')] = filepath
+                else:
+                    files[os.path.relpath(match, static_directory).replace(os.sep, '/')] = match
+        return files
+
+    ## Return the SHA-256 of the content of the static file 'filename'. It is
+    #  computed again only if the state of the file changed.
+    def staticFileDigest(self, filename):
+        state = fileState(filename)
+        cached = self.static_digests.get(filename)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        hash = sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                hash.update(chunk)
+        self.static_digests[filename] = (state, hash.hexdigest())
+        if self.profile is not None:
+            self.profile['counters']['static_files_hashed'] += 1
+        return self.static_digests[filename][1]
+
+    ## Return the dictionary of the links to the static files in 'files' (see
+    #  getStaticFiles): each key is 'static:' followed by the name of the file and
+    #  its value the path of the published file relative to public_path. If
+    #  'fingerprint' is True, files are published also with the digest of their
+    #  content in their name (see fingerprintName), and links point to those
+    #  files, that can be cached forever. The fingerprinted files are added to
+    #  'files'.
+    def getStaticLinks(self, files, fingerprint):
+        directory = makePathNormalized(self.config['STATIC'])
+        static_links = {}
+        for name, source in list(files.items()):
+            if fingerprint:
+                published_name = fingerprintName(name, self.staticFileDigest(source))
+                files[published_name] = source
+            else:
+                published_name = name
+            static_links['static:' + name] = directory + published_name
+        return static_links
+
+    ## Generate the derivatives of the static images in 'files' (see
+    #  getStaticFiles) in the widths and formats of the configuration (IMAGE_WIDTHS,
+    #  IMAGE_FORMATS and IMAGE_QUALITY), with a process for each CPU. Derivatives
+    #  are added to 'files', with the digest in the name if 'fingerprint' is True,
+    #  and it returns the dictionary of the links to their srcset: 'srcset-'
+    #  followed by the format, ':' and the name of the image ('srcset:' for the
+    #  first format). Each link is a list of (path, width) of the derivatives.
+    def getImageLinks(self, files, names, fingerprint):
+        widths = sorted(self.config['IMAGE_WIDTHS'])
+        image_formats = [image_format.lower() for image_format in self.config.get('IMAGE_FORMATS', default_image_formats)]
+        quality = self.config.get('IMAGE_QUALITY', default_image_quality)
+        directory = makePathNormalized(self.config['STATIC'])
+        images = [name for name in names if os.path.splitext(name)[1].lower() in image_extensions]
+        static_names = set(names)
+        image_links = {}
+
+        # Without Pillow the srcset contains only the original image
+        if Image is None:
+            if images:
+                logging.error('Pillow is not installed: image derivatives are not generated.')
+            for name in images:
+                for image_format in image_formats:
+                    image_links[f'srcset-{image_format}:{name}'] = [[directory + name, None]]
+                image_links['srcset:' + name] = image_links[f'srcset-{image_formats[0]}:{name}']
+            return image_links
+
+        Image.init()
+        for image_format in list(image_formats):
+            if image_format.upper() not in Image.SAVE:
+                logging.error(f'Pillow can not save images in {image_format} format.')
+                image_formats.remove(image_format)
+        if not image_formats:
+            return image_links
+
+        images_directory = self.working_path + images_cache_path
+        if self.image_sizes is None:
+            try:
+                with open(images_directory + 'sizes.json', 'r') as sizesfile:
+                    self.image_sizes = json.load(sizesfile)
+            except (FileNotFoundError, ValueError):
+                self.image_sizes = {}
+
+        # Images with some derivatives missing are converted by the worker processes
+        digests = {name: self.staticFileDigest(files[name]) for name in images}
+        to_convert = [name for name in images
+                      if digests[name] not in self.image_sizes or
+                      any(not os.path.isfile(imageDerivativeName(images_directory, digests[name], width, image_format, quality))
+                          for width in getImageWidths(self.image_sizes[digests[name]][0], widths)
+                          for image_format in image_formats)]
+        if to_convert:
+            logging.info(f'Generating the derivatives of {len(to_convert)} images...')
+            os.makedirs(images_directory, exist_ok = True)
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = None
+            with concurrent.futures.ProcessPoolExecutor(mp_context = context) as executor:
+                futures = {name: executor.submit(convertImage, files[name], digests[name], images_directory, widths, image_formats, quality)
+                           for name in to_convert}
+                for name, future in futures.items():
+                    try:
+                        self.image_sizes[digests[name]] = list(future.result())
+                    except Exception as e:
+                        logging.error(f'while converting {files[name]} the following error: {e}')
+            with open(images_directory + 'sizes.json', 'w') as sizesfile:
+                json.dump(self.image_sizes, sizesfile)
+            if self.profile is not None:
+                self.profile['counters']['images_converted'] += len(to_convert)
+
+        for name in images:
+            if digests[name] not in self.image_sizes:
+                continue
+            for image_format in image_formats:
+                srcset = []
+                for width in getImageWidths(self.image_sizes[digests[name]][0], widths):
+                    filename = imageDerivativeName(images_directory, digests[name], width, image_format, quality)
+                    # The extension of the image is kept, not to mix photo.jpg and photo.png
+                    published_name = f'{name}-{width}w.{image_format}'
+                    if fingerprint:
+                        published_name = fingerprintName(published_name, os.path.basename(filename))
+                    if published_name in static_names:
+                        logging.error(f'The derivative {published_name} of {name} has the name of a static file, it is not published.')
+                        continue
+                    files[published_name] = filename
+                    srcset.append([directory + published_name, width])
+                image_links[f'srcset-{image_format}:{name}'] = srcset
+            image_links['srcset:' + name] = image_links[f'srcset-{image_formats[0]}:{name}']
+        return image_links
+
+    ## Add to 'files' (see getStaticFiles) the compressed variants of the text
+    #  static files, in the encodings of precompress_encodings (see
+    #  writeCompressedFiles). Compressed files are cached in compressed_cache_path
+    #  by the digest of their content, so they are compressed only once, with
+    #  precompress_threads threads.
+    def addCompressedFiles(self, files):
+        compressed_directory = self.working_path + compressed_cache_path
+        sources = {name: source for name, source in files.items()
+                   if isCompressible(name) and os.path.getsize(source) >= precompress_min_size}
+        digests = {name: self.staticFileDigest(source) for name, source in sources.items()}
+        to_compress = {compressed_directory + digests[name] + '.' + encoding: (source, encoding)
+                       for name, source in sources.items() for encoding in self.precompress_encodings
+                       if not os.path.isfile(compressed_directory + digests[name] + '.' + encoding)}
+
+        def compressFile(filename, source, encoding):
+            with open(source, 'rb') as sourcefile:
+                data = compressData(sourcefile.read(), encoding)
+            # The cached file is complete or missing, even if the build is interrupted
+            with open(filename + '.tmp', 'wb') as compressedfile:
+                compressedfile.write(data)
+            os.replace(filename + '.tmp', filename)
+
+        if to_compress:
+            logging.info(f'Compressing {len(to_compress)} static files...')
+            os.makedirs(compressed_directory, exist_ok = True)
+            with concurrent.futures.ThreadPoolExecutor(max_workers = precompress_threads) as executor:
+                futures = {filename: executor.submit(compressFile, filename, source, encoding)
+                           for filename, (source, encoding) in to_compress.items()}
+                for filename, future in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f'while compressing {to_compress[filename][0]} the following error: {e}')
+
+        for name, source in sources.items():
+            size = os.path.getsize(source)
+            for encoding in self.precompress_encodings:
+                filename = compressed_directory + digests[name] + '.' + encoding
+                if os.path.isfile(filename) and os.path.getsize(filename) <= size * precompress_max_ratio:
+                    files[name + '.' + encoding] = filename
+
+    ## Write the manifest of the static files in the output: a JSON object whose
+    #  keys are the names of the files and their values the paths of the
+    #  published files relative to public_path.
+    def writeAssetManifest(self):
+        manifest = {tag[len('static:'):]: path for tag, path in sorted(self.static_links.items()) if tag.startswith('static:')}
+        filename = self.working_path + self.output_path + asset_manifest_name
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        if os.path.lexists(filename):
+            os.remove(filename)
+        with open(filename, 'w') as manifestfile:
+            json.dump(manifest, manifestfile, indent = 2)
+
+    ## Synchronize the static directory of the output with the static files in
+    #  'files' (see getStaticFiles): only new and changed files are copied, with
+    #  static_copy_threads threads, and files no longer present are removed.
+    #  'mode' is 'copy', 'hardlink' or 'reflink'. It returns the names of the
+    #  files copied or removed.
+    def syncStaticFiles(self, files, mode = 'copy', checksum = False):
+        destination_directory = self.working_path + self.output_path + self.config['STATIC'] + '/'
+
+        # Remove the files no longer published
+        removed = []
+        for dirpath, dirnames, filenames in os.walk(destination_directory, topdown = False):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                name = os.path.relpath(filepath, destination_directory).replace(os.sep, '/')
+                if name not in files:
+                    os.remove(filepath)
+                    removed.append(name)
+            if os.path.normpath(dirpath) != os.path.normpath(destination_directory) and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+        start = time.perf_counter()
+        to_copy = [name for name in files if not isStaticFileSynced(files[name], destination_directory + name, mode, checksum)]
+        if self.profile is not None:
+            self.profilePhase('static check', start)
+            start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = static_copy_threads) as executor:
+            for name in to_copy:
+                executor.submit(copyStaticFile, files[name], destination_directory + name, mode)
+        if self.profile is not None:
+            self.profilePhase('static copy', start)
+            self.profile['counters']['static_files_copied'] += len(to_copy)
+            self.profile['counters']['static_bytes_copied'] += sum(os.path.getsize(files[name]) for name in to_copy)
+
+        logging.info(f'Static files: {len(to_copy)} copied, {len(removed)} removed, {len(files) - len(to_copy)} not changed.')
+        return to_copy + removed
+
+    ## Create the staging directory, with the content of public_path linked
+    #  (only the static files if 'only_static' is True). Files are hardlinked,
+    #  so nothing is copied and the published website is never modified.
+    def prepareStage(self, only_static = False):
+        # Remove what was left by interrupted builds
+        shutil.rmtree(self.working_path + staging_path, ignore_errors = True)
+        for trash in glob.glob(self.working_path + cache_path + 'trash-*'):
+            threading.Thread(target = shutil.rmtree, args = (trash, True)).start()
+
+        source = self.working_path + public_path
+        destination = self.working_path + staging_path
+        if only_static:
+            source += self.config['STATIC']
+            destination += self.config['STATIC']
+        if os.path.isdir(source):
+            shutil.copytree(source, destination, symlinks = True, copy_function = linkOrCopyFile)
+        os.makedirs(self.working_path + staging_path, exist_ok = True)
+
+    ## Replace public_path with the staging directory. The old public directory
+    #  is deleted by a background thread, after it has been replaced.
+    def publishStage(self):
+        public_directory = os.path.normpath(self.working_path + public_path)
+        staging_directory = os.path.normpath(self.working_path + staging_path)
+        trash = os.path.normpath(self.working_path + cache_path + f'trash-{os.getpid()}-{time.monotonic_ns()}')
+
+        if not os.path.exists(public_directory):
+            os.rename(staging_directory, public_directory)
+            return
+        if exchangeDirectories(staging_directory, public_directory):
+            os.rename(staging_directory, trash)
+        else:
+            # Not atomic, but public_directory is missing only between two renames
+            os.rename(public_directory, trash)
+            os.rename(staging_directory, public_directory)
+        threading.Thread(target = shutil.rmtree, args = (trash, True)).start()
+
+    ## Write the deploy manifest in cache_path: a JSON object with the SHA-256,
+    #  size, MIME type and encoding (only of the compressed variants written with
+    #  --precompress, like 'gzip') of every file in public_path ('files'), and
+    #  the lists of the files added, changed (in their content) and removed since
+    #  the previous manifest. Files are hashed again only if their state changed
+    #  (see staticFileDigest). It returns the manifest.
+    def writeDeployManifest(self):
+        public_directory = self.working_path + public_path
+        filename = self.working_path + cache_path + deploy_manifest_name
+        try:
+            with open(filename, 'r') as manifestfile:
+                old_files = json.load(manifestfile)['files']
+        except (FileNotFoundError, ValueError, KeyError):
+            old_files = {}
+
+        names = []
+        for dirpath, dirnames, filenames in os.walk(public_directory):
+            for name in filenames:
+                names.append(os.path.relpath(os.path.join(dirpath, name), public_directory).replace(os.sep, '/'))
+        names.sort()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = static_copy_threads) as executor:
+            digests = list(executor.map(lambda name: self.staticFileDigest(public_directory + name), names))
+        files = {}
+        published = set(names)
+        for name, digest in zip(names, digests):
+            content_type, encoding = mimetypes.guess_type(name)
+            # Only the compressed variants written by swamp have the type of the
+            # file next to them, other compressed files are archives
+            root, extension = os.path.splitext(name)
+            if encoding is not None and not (extension in ('.gz', '.br') and root in published and isCompressible(root)):
+                content_type = 'application/gzip' if encoding == 'gzip' else None
+                encoding = None
+            files[name] = {'sha256': digest,
+                           'size': self.static_digests[public_directory + name][0][1],
+                           'type': content_type or 'application/octet-stream'}
+            if encoding is not None:
+                files[name]['encoding'] = encoding
+
+        manifest = {'files': files,
+                    'added': [name for name in files if name not in old_files],
+                    'changed': [name for name in files if name in old_files and old_files[name]['sha256'] != files[name]['sha256']],
+                    'removed': sorted(name for name in old_files if name not in files)}
+        os.makedirs(self.working_path + cache_path, exist_ok = True)
+        with open(filename + '.tmp', 'w') as manifestfile:
+            json.dump(manifest, manifestfile, indent = 1)
+        os.replace(filename + '.tmp', filename)
+        logging.info(f"Deploy manifest: {len(manifest['added'])} files added, {len(manifest['changed'])} changed, "
+                     f"{len(manifest['removed'])} removed.")
+        return manifest
+
+    ## Upload the website to 'destination' ('s3://bucket/prefix') with an
+    #  S3-compatible API (see S3Uploader), as listed in the deploy manifest.
+    #  Only the files that changed since the last upload to the same
+    #  destination are uploaded, with 'connections' concurrent connections,
+    #  and the ones no longer published are deleted. The files uploaded are
+    #  recorded in cache_path even if some uploads fail, so that only the
+    #  missing ones are uploaded again.
+    def uploadWebsite(self, destination, connections = upload_connections):
+        public_directory = self.working_path + public_path
+        with open(self.working_path + cache_path + deploy_manifest_name, 'r') as manifestfile:
+            files = json.load(manifestfile)['files']
+        uploaded_filename = self.working_path + cache_path + uploaded_manifest_name
+        try:
+            with open(uploaded_filename, 'r') as uploadedfile:
+                uploaded = json.load(uploadedfile)
+        except (FileNotFoundError, ValueError):
+            uploaded = None
+        if uploaded is None or uploaded.get('destination') != destination:
+            uploaded = {'destination': destination, 'files': {}}
+
+        to_upload = [name for name, entry in files.items() if uploaded['files'].get(name) != entry['sha256']]
+        to_delete = [name for name in uploaded['files'] if name not in files]
+        logging.info(f'Uploading {len(to_upload)} files and deleting {len(to_delete)} files in {destination}...')
+        uploader = S3Uploader(destination)
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers = connections) as executor:
+            uploads = {name: executor.submit(uploader.put, name, public_directory + name, files[name]['type'], files[name]['sha256'],
+                                             files[name].get('encoding'))
+                       for name in to_upload}
+            deletions = {name: executor.submit(uploader.delete, name) for name in to_delete}
+            for name, future in uploads.items():
                 try:
-                    shutil.copytree(working_path + static_path + elementname,
-                                    working_path + public_path + config['STATIC'] + elementname)
+                    future.result()
+                    uploaded['files'][name] = files[name]['sha256']
                 except Exception as e:
-                    logging.error(f'while copyng dir {elementname} the following error: {e}')
-            elif os.path.isfile(working_path + static_path + elementname):
+                    errors.append(f'  {name}: {e}')
+            for name, future in deletions.items():
                 try:
-                    os.makedirs(os.path.dirname(working_path + public_path + config['STATIC'] + elementname),
-                                exist_ok = True) # creating missing folders
-                    shutil.copyfile(working_path + static_path + elementname,
-                                 working_path + public_path + config['STATIC'] + elementname)
+                    future.result()
+                    del uploaded['files'][name]
                 except Exception as e:
-                    logging.error(f'while copyng dir {elementname} the following error: {e}')
+                    errors.append(f'  {name}: {e}')
+
+        with open(uploaded_filename + '.tmp', 'w') as uploadedfile:
+            json.dump(uploaded, uploadedfile)
+        os.replace(uploaded_filename + '.tmp', uploaded_filename)
+        if errors:
+            raise UploadError(f'{len(errors)} files not uploaded or deleted:\n' + '\n'.join(errors))
+        logging.info('Upload completed.')
+
+    ## Return a copy of the state of the last build used by the next one, to
+    #  restore it if a build is cancelled (see restoreState).
+    def saveState(self):
+        return {'file_states': dict(self.file_states),
+                'dependencies': dict(self.dependencies),
+                'links': dict(self.links),
+                'pages': dict(self.pages),
+                'collection_paths': dict(self.collection_paths),
+                'collection_pages': dict(self.collection_pages),
+                'static_state': self.static_state,
+                'static_files': self.static_files,
+                'static_links': self.static_links,
+                'build_cache': self.build_cache,
+                'search_index': self.search_index,
+                'cached_pages': dict(self.build_cache['pages']) if self.build_cache is not None else None}
+
+    ## Restore the state saved by saveState, so that the next build finds all
+    #  the changes since the last build that was completed.
+    def restoreState(self, state):
+        for name in ('file_states', 'dependencies', 'links', 'pages', 'collection_paths', 'collection_pages'):
+            getattr(self, name).clear()
+            getattr(self, name).update(state[name])
+        self.static_state = state['static_state']
+        self.static_files = state['static_files']
+        self.static_links = state['static_links']
+        self.build_cache = state['build_cache']
+        self.search_index = state['search_index']
+        if self.build_cache is not None:
+            self.build_cache['pages'] = state['cached_pages']
+
+    ## Release the directories loaded and forget the pages staged in memory by
+    #  a build interrupted while building the pages.
+    def abortPages(self):
+        while self.loaded_directories:
+            self.releaseDirectory(self.loaded_directories[-1])
+        if self.memory_pages is not None:
+            self.memory_pages.rollback()
+
+    ## Stop the build running, if any, as soon as possible: it raises
+    #  BuildCancelled, and the state of the last build is restored. The
+    #  website must be staged, otherwise public_path is left partially built.
+    def cancel(self):
+        self.cancelled.set()
+
+    ## Raise BuildCancelled if the build was cancelled
+    def checkCancelled(self):
+        if self.cancelled.is_set():
+            raise BuildCancelled('Build cancelled')
+
+    ## Build the website. If 'incremental' is True and there is a previous build,
+    #  only the pages affected by the files changed since then are built again.
+    #  'changed_paths' are the paths changed since the last build, if known,
+    #  otherwise the state of every file used is checked.
+    #  If 'jobs' is greater than 1, pages are built by that number of forked
+    #  processes. Since forking a process with other threads running is not
+    #  safe, builds run outside the main thread are always sequential.
+    #  If 'cache' is True, the pages that did not change since the last build
+    #  (also of a previous run) are not built again.
+    #  'static_mode' and 'static_checksum' are used to synchronize static files
+    #  (see syncStaticFiles), and if 'fingerprint' is True they are also published
+    #  with the digest of their content in the name (see getStaticLinks).
+    #  If 'staged' is True the website is built in staging_path, and then it
+    #  replaces public_path at once. If 'strict' is True undefined variables
+    #  are errors, and the website is staged, so that it is not published. If 'deploy_manifest' is True the deploy
+    #  manifest is written (see writeDeployManifest). If 'precompress' is True,
+    #  gzip and brotli variants of pages and text static files are written next
+    #  to them. If 'search' is True, the search index of the pages is published
+    #  with the static files (see SearchIndex).
+    #  A build waits for the one running, if any.
+    def generateWebsite(self, static_file_list = None, incremental = False, changed_paths = None, jobs = 1, cache = False,
+                        static_mode = 'copy', static_checksum = False, staged = False, strict = False, minify = None,
+                        profile_build = False, fingerprint = False, deploy_manifest = False,
+                        precompress = False, search = False):
+        with self.lock:
+            if profile_build:
+                self.startProfile()
             else:
-                logging.error("Unknown static file or directory: {}".format(elementname))
-
-def generateWebsite(static_file_list = None):
-    # Clear the public from old files
-    #shutil.rmtree(working_path + public_path, ignore_errors = True)
-    try:
-        emptyFolder(working_path + public_path)
-    except FileNotFoundError:
-        pass
-
-    # Load basics
-    logging.info('Loading basic config...')
-    loadTemplate(working_path)
-    loadConfig(working_path)
-    loadVariables(working_path)
+                self.profile = None
+            phase_start = time.perf_counter()
+            self.strict_mode = strict
+            # A strict build is staged, so that it is not published if it fails
+            staged = staged or strict
+            self.minify_mode = minify
+            if not precompress:
+                self.precompress_encodings = []
+            elif brotli is None:
+                logging.error('brotli is not installed, pages are precompressed only with gzip')
+                self.precompress_encodings = ['gz']
+            else:
+                self.precompress_encodings = ['gz', 'br']
+            self.output_path = public_path
+            self.pushed_pages = {} if self.memory_pages is not None else None
+            changed_static_files = []
+            self.cancelled.clear()
+            saved_state = self.saveState()
 
-    # Setting the link for static files
-    links['static'] = config['STATIC']
+            try:
+                # Find the files changed since the last build
+                changed_files = None
+                if incremental and self.dependencies:
+                    if changed_paths is None:
+                        actual_states = {filename: fileState(filename) for filename in self.file_states}
+                    else:
+                        actual_states = {filename: fileState(filename) for filename in changed_paths if filename in self.file_states}
+                    changed_files = {filename for filename in actual_states if self.file_states[filename] != actual_states[filename]}
+                    self.file_states.update(actual_states)
+                    # The template and the configuration are used by every page
+                    if self.working_path + 'template.html' in changed_files or self.working_path + 'config.yaml' in changed_files:
+                        changed_files = None
+                    # A new search index needs all pages
+                    if search and self.search_index is None:
+                        changed_files = None
+
+                old_links = dict(self.links)
+                old_pages = dict(self.pages)
+                old_collection_pages = dict(self.collection_pages)
+                self.file_digests.clear()
+                self.compiled_HTML_files.clear()
+                self.compiled_values.clear()
+                if not cache:
+                    self.build_cache = None
+                elif changed_files is None:
+                    self.build_cache = self.loadBuildCache()
+                    if self.build_cache is not None:
+                        self.static_digests.update((filename, ((mtime, size), digest))
+                                                   for filename, (mtime, size, digest) in self.build_cache.get('static', {}).items())
+                if cache:
+                    self.loadYAMLCache()
+                # The search index of a full build is new, or the one of the build cache
+                if not search:
+                    self.search_index = None
+                elif changed_files is None:
+                    self.search_index = None
+                    if self.build_cache is not None:
+                        self.search_index = SearchIndex.load(self.working_path + cache_path + 'search.pickle')
+                    if self.search_index is None:
+                        self.search_index = SearchIndex()
+                self.indexed_pages = {}
+                if self.profile is not None:
+                    self.profilePhase('changes and cache', phase_start)
+                    phase_start = time.perf_counter()
+
+                # Load basics
+                logging.info('Loading basic config...')
+                self.variables.clear()
+                self.loadTemplate(self.working_path)
+                self.loadConfig(self.working_path)
+                self.loadVariables(self.working_path)
+
+                if staged:
+                    stage_start = time.perf_counter()
+                    self.prepareStage(only_static = changed_files is None and self.build_cache is None)
+                    self.output_path = staging_path
+                    if self.profile is not None:
+                        self.profilePhase('stage', stage_start)
+                    self.checkCancelled()
+
+                if changed_files is None:
+                    if self.build_cache is None:
+                        # Clear the public from old files, static ones are synchronized later
+                        #shutil.rmtree(working_path + public_path, ignore_errors = True)
+                        try:
+                            emptyFolder(self.working_path + self.output_path, keep = [makePathNormalized(self.config['STATIC']).split('/')[0]])
+                        except FileNotFoundError:
+                            pass
+                        if cache:
+                            self.build_cache = {'files': {}, 'pages': {}}
+                    else:
+                        # Pages are kept, the ones no longer generated are removed later
+                        logging.info('Using the build cache...')
+                        old_pages = {path: (cached_page['tag'], cached_page['paths']) for path, cached_page in self.build_cache['pages'].items()}
+                    self.dependencies.clear()
+                    self.file_states.clear()
+                    self.static_state = {}
+                else:
+                    logging.info(f'Changed files: {sorted(changed_files)}')
+
+                # Setting the link for static files
+                self.links.clear()
+                self.pages.clear()
+                self.collection_paths.clear()
+                self.collection_pages.clear()
+                self.collection_scopes.clear()
+                self.dangling_links.clear()
+                self.undefined_variables.clear()
+                self.links['static'] = self.config['STATIC']
+
+                # Links to static files, updated only if something changed
+                static_paths = [os.path.normpath(self.working_path + static_path)]
+                if static_file_list is not None:
+                    static_paths.append(os.path.normpath(static_file_list))
+                if changed_files is not None and changed_paths is not None and \
+                   not any(os.path.normpath(path) == static or os.path.normpath(path).startswith(static + os.sep)
+                           for path in changed_paths for static in static_paths):
+                    actual_static_state = self.static_state
+                else:
+                    actual_static_state = self.staticFilesState()
+                if actual_static_state != self.static_state:
+                    try:
+                        self.static_files = self.getStaticFiles(static_file_list)
+                    except FileNotFoundError as e:
+                        logging.error("{} not found! No static file copied.".format(static_file_list))
+                        self.static_files = {}
+                    static_names = list(self.static_files)
+                    self.static_links = self.getStaticLinks(self.static_files, fingerprint)
+                    if 'IMAGE_WIDTHS' in self.config:
+                        self.static_links.update(self.getImageLinks(self.static_files, static_names, fingerprint))
+                    if self.precompress_encodings:
+                        self.addCompressedFiles(self.static_files)
+                self.links.update(self.static_links)
+
+                # Variable timestamp
+                pushScope(self.variables, {'timestamp':str(int(datetime.datetime.now().timestamp()*1000))})
+
+                # Setting languages configuaration
+                self.alt_languages = []
+                try:
+                    self.alt_languages[:] = self.config['ALT_LANGUAGES']
+                except KeyError:
+                    pass
 
-    # Variable timestamp
-    variables.append({'timestamp':str(int(datetime.datetime.now().timestamp()*1000))})
+                self.alt_languages.append('meta')
+                logging.info(f'Loaded alternativies languages: {self.alt_languages}')
 
-    # Setting languages configuaration
-    alt_languages = []
-    try:
-        alt_languages[:] = config['ALT_LANGUAGES']
-    except KeyError:
-        pass
+                self.locale[self.config['DEFAULT_LANGUAGE']] = []
+                for alt_lang in self.alt_languages:
+                    self.locale[alt_lang] = []
+                    self.alt_languages_path[alt_lang] = ''
 
-    alt_languages.append('meta')
-    logging.info(f'Loaded alternativies languages: {alt_languages}')
+                try:
+                    self.subdirectory_default_language = self.config['DEFAULT_LANGUAGE_SUBDIRECTORY']
+                except KeyError:
+                    pass
+                # Load global locale if it is present
+                try:
+                    self.loadPathNames(self.working_path)
+                    self.loadLocale(self.working_path)
+                except FileNotFoundError:
+                    pass
 
-    locale[config['DEFAULT_LANGUAGE']] = []
-    for alt_lang in alt_languages:
-        locale[alt_lang] = []
-        alt_languages_path[alt_lang] = ''
+                if self.profile is not None:
+                    self.profilePhase('load', phase_start)
+                    phase_start = time.perf_counter()
+
+                # Collect the links to all pages
+                logging.info('Collecting links...')
+                exploreSubdirectory(self.working_path + source_path,
+                                    self.registerDirectory,
+                                    self.unloadPathNames)
+                if self.profile is not None:
+                    self.profilePhase('links', phase_start)
+                    phase_start = time.perf_counter()
+                self.checkCancelled()
+
+                # Build all pages, or only the affected ones
+                if changed_files is None:
+                    self.pages_to_build = None
+                    logging.info('Building pages...')
+                    explore = None
+                    if self.build_cache is not None:
+                        self.removeStalePages(old_pages)
+                else:
+                    self.removeStalePages(old_pages)
+                    self.pages_to_build = self.getAffectedPages(changed_files, old_links, old_pages, old_collection_pages)
+                    logging.info(f'Building {len(self.pages_to_build)} pages...')
+                    # Only directories containing a page to build are explored
+                    to_explore = {ancestor for path in self.pages_to_build for ancestor in self.getSourceAncestors(path)}
+                    explore = lambda path: makePathEndWithSlash(path) in to_explore
+                try:
+                    if jobs > 1 and threading.current_thread() is not threading.main_thread():
+                        logging.warning('Pages are built by a single process outside the main thread.')
+                        jobs = 1
+                    if jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+                        self.buildPagesInParallel([path for path in self.pages if self.pages_to_build is None or path in self.pages_to_build], jobs)
+                    else:
+                        self.page_writer = PageWriter(page_writer_threads, page_writer_queue_depth, self.precompress_encodings)
+                        exploreSubdirectory(self.working_path + source_path,
+                                            self.processDirectory,
+                                            self.releaseDirectory,
+                                            explore)
+                        self.page_writer.close()
+                except BuildCancelled:
+                    raise
+                except:
+                    # The dependencies are not reliable anymore
+                    self.abortPages()
+                    self.dependencies.clear()
+                    raise
+                finally:
+                    self.pages_to_build = None
+                    if self.page_writer is not None:
+                        self.page_writer.join()
+                        self.page_writer = None
+                if self.profile is not None:
+                    self.profilePhase('render', phase_start)
+                    phase_start = time.perf_counter()
+            except BuildCancelled:
+                # The changes are built by the next build
+                self.abortPages()
+                self.restoreState(saved_state)
+                raise
+
+            # Add the pages built to the search index, only the shards that changed are written
+            search_files = {}
+            search_changed = False
+            if self.search_index is not None:
+                self.search_index.update(self.indexed_pages, self.pages)
+                self.indexed_pages = {}
+                index_files, search_changed = self.search_index.write(self.working_path + search_cache_path, self.config['LOCATION'])
+                search_files = {search_directory + '/' + name: filename for name, filename in index_files.items()}
+                if self.profile is not None:
+                    self.profilePhase('search', phase_start)
+                    phase_start = time.perf_counter()
+
+            # Copy static files to public directory, if something changed
+            if actual_static_state == self.static_state and search_files == self.search_files and not search_changed:
+                logging.info('Static files not changed.')
+            else:
+                logging.info('Copying static files...')
+                if static_file_list is not None:
+                    logging.info('Copy from list {}'.format(static_file_list))
+                changed_static_files = self.syncStaticFiles({**self.static_files, **search_files}, static_mode, static_checksum)
+            self.static_state = actual_static_state
+            self.search_files = search_files
+            if fingerprint:
+                self.writeAssetManifest()
+            elif os.path.lexists(self.working_path + self.output_path + asset_manifest_name):
+                os.remove(self.working_path + self.output_path + asset_manifest_name)
+            if self.profile is not None:
+                self.profilePhase('static', phase_start)
+                phase_start = time.perf_counter()
+
+            # Report the variables not defined, a strict build is not published
+            if self.undefined_variables:
+                message = 'Undefined variables:\n' + '\n'.join(
+                    f'  {expression} in {source}, offset {offset}: {len(directories)} pages, looked up in '
+                    + ', '.join(sorted(directories)[:3]) + (', ...' if len(directories) > 3 else '')
+                    for (expression, source, offset), directories in self.undefined_variables.items())
+                if self.strict_mode:
+                    # The next build finds again the changes of this one, and indexes all pages
+                    self.abortPages()
+                    self.restoreState(saved_state)
+                    self.search_index = None
+                    raise TemplateError(message)
+                logging.warning(message)
+
+            # Publish the staged website
+            if staged:
+                logging.info('Publishing...')
+                self.publishStage()
+                self.output_path = public_path
+                if self.profile is not None:
+                    self.profilePhase('publish', phase_start)
+                    phase_start = time.perf_counter()
+
+            # Serve the new pages from memory and reload the ones that changed
+            if self.memory_pages is not None:
+                all_paths = {page_path for tag, paths in self.pages.values() for page_path in paths.values()}
+                changed_urls = ['/' + path for path in self.memory_pages.commit(self.pushed_pages, all_paths)]
+                changed_urls += ['/' + makePathNormalized(self.config['STATIC']) + name for name in changed_static_files]
+                self.broadcastReload(changed_urls)
+                self.pushed_pages = None
+
+            # List the published files, with the changes since the last build
+            deployed_files = set()
+            if deploy_manifest:
+                manifest = self.writeDeployManifest()
+                deployed_files = {self.working_path + public_path + name for name in manifest['files']}
+                if self.profile is not None:
+                    self.profilePhase('manifest', phase_start)
+                    phase_start = time.perf_counter()
+
+            # Save the build cache without the pages and files no longer used
+            if self.build_cache is not None:
+                self.build_cache['pages'] = {path: self.build_cache['pages'][path] for path in self.pages if path in self.build_cache['pages']}
+                used_files = {filename for files, tags in self.dependencies.values() for filename in files}
+                self.build_cache['files'] = {filename: state for filename, state in self.build_cache['files'].items() if filename in used_files}
+                static_sources = set(self.static_files.values())
+                self.build_cache['static'] = {filename: [state[0], state[1], digest] for filename, (state, digest) in self.static_digests.items()
+                                              if (filename in static_sources or filename in deployed_files) and state is not None}
+                self.saveBuildCache()
+                if self.search_index is not None:
+                    self.search_index.save(self.working_path + cache_path + 'search.pickle')
+            if cache:
+                self.saveYAMLCache()
+            if self.profile is not None:
+                self.profilePhase('save cache', phase_start)
+                self.saveProfile()
+
+            # Report all the links that were not possible to build
+            if self.dangling_links:
+                raise LinkError('Links to unknown tags:\n' + '\n'.join(
+                    f'  {expression} ({lang}) in {source}, offset {offset}: {count} pages'
+                    for (expression, lang, source, offset), count in self.dangling_links.items()))
+
+    ## Send the URLs changed by the last build to all the pages connected for
+    #  live reload. Too many URLs are replaced by '*'.
+    def broadcastReload(self, urls):
+        if not urls:
+            return
+        if len(urls) > live_reload_max_urls:
+            urls = ['*']
+        message = 'event: reload\ndata: {}\n\n'.format(json.dumps(sorted(urls)))
+        with self.live_reload_lock:
+            for client in self.live_reload_clients:
+                client.put(message)
+
+    ## Build the website as generateWebsite (with the same arguments) in a
+    #  thread, so that the event loop is not blocked by the build and can run
+    #  other builds at the same time.
+    async def generateWebsiteAsync(self, **kwargs):
+        return await asyncio.to_thread(self.generateWebsite, **kwargs)
+
+## Initialize a worker process building pages (see buildPagesInParallel).
+#  Workers are forked, so 'builder' is not copied.
+def initializeWorker(builder):
+    global worker_builder
+    worker_builder = builder
+
+## Build the pages of the directories in 'paths' with the builder of the
+#  worker process (see Builder.buildPagesInWorker).
+def buildPagesInWorker(paths):
+    return worker_builder.buildPagesInWorker(paths)
+
+## Return the headers of a request to the S3 API of 'region', signed with
+#  AWS Signature Version 4. 'path' must be already URI-encoded, and
+#  'payload_hash' is the SHA-256 of the body of the request.
+def signS3Request(method, host, path, headers, payload_hash, region, access_key, secret_key,
+                  session_token = None, now = None):
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    scope = f'{amz_date[:8]}/{region}/s3/aws4_request'
+    headers = dict(headers, host = host)
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+    if session_token is not None:
+        headers['x-amz-security-token'] = session_token
+
+    canonical_headers = sorted((name.lower(), ' '.join(str(value).split())) for name, value in headers.items())
+    signed_headers = ';'.join(name for name, value in canonical_headers)
+    canonical_request = '\n'.join([method, path, '',
+                                   ''.join(f'{name}:{value}\n' for name, value in canonical_headers),
+                                   signed_headers, payload_hash])
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                sha256(canonical_request.encode('utf-8')).hexdigest()])
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in scope.split('/'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, '
+                                f'SignedHeaders={signed_headers}, Signature={signature}')
+    return headers
+
+## Client of an S3-compatible API, uploading files in 's3://bucket/prefix'
+#  from many threads. The endpoint, region and credentials are read from the
+#  environment variables AWS_ENDPOINT_URL (default the one of Amazon S3),
+#  AWS_REGION (default us-east-1), AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+#  and AWS_SESSION_TOKEN. Buckets are addressed in the path of the URLs, and
+#  each thread keeps its connection open.
+class S3Uploader:
+    EMPTY_PAYLOAD_HASH = sha256(b'').hexdigest()
+
+    def __init__(self, destination):
+        parts = urllib.parse.urlsplit(destination)
+        if parts.scheme != 's3' or not parts.netloc:
+            raise UploadError(f'Invalid destination {destination}, it must be s3://bucket/prefix')
+        self.bucket = parts.netloc
+        self.prefix = makePathStartWithoutSlash(parts.path)
+        if self.prefix:
+            self.prefix = makePathEndWithSlash(self.prefix)
+        self.region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        self.endpoint = urllib.parse.urlsplit(os.environ.get('AWS_ENDPOINT_URL') or f'https://s3.{self.region}.amazonaws.com')
+        self.access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.session_token = os.environ.get('AWS_SESSION_TOKEN')
+        if not self.access_key or not self.secret_key:
+            raise UploadError('AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY must be set to upload the website.')
+        self.local = threading.local()
+
+    ## Send a request for the object 'name' and return the body of the
+    #  response. A connection closed by the server is opened again once.
+    def request(self, method, name, body = None, headers = {}, payload_hash = EMPTY_PAYLOAD_HASH):
+        path = (self.endpoint.path.rstrip('/') + '/' + urllib.parse.quote(self.bucket) + '/' +
+                urllib.parse.quote(self.prefix + name, safe = '/-_.~'))
+        for attempt in range(2):
+            connection = getattr(self.local, 'connection', None)
+            if connection is None:
+                if self.endpoint.scheme == 'https':
+                    connection = http.client.HTTPSConnection(self.endpoint.netloc, timeout = 60)
+                else:
+                    connection = http.client.HTTPConnection(self.endpoint.netloc, timeout = 60)
+                self.local.connection = connection
+            signed_headers = signS3Request(method, self.endpoint.netloc, path, headers, payload_hash, self.region,
+                                           self.access_key, self.secret_key, self.session_token)
+            try:
+                if body is not None:
+                    body.seek(0)
+                connection.request(method, path, body = body, headers = signed_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                self.local.connection = None
+                if attempt > 0:
+                    raise
+                continue
+            if response.status >= 300:
+                raise UploadError(f'{method} {path}: {response.status} {response.reason} {data[:300].decode("utf-8", "replace")}')
+            return data
+
+    ## Upload the file 'filename' as the object 'name', whose SHA-256 is 'digest'.
+    #  The content of compressed files is encoded with 'encoding'.
+    def put(self, name, filename, content_type, digest, encoding = None):
+        with open(filename, 'rb') as datafile:
+            headers = {'Content-Type': content_type, 'Content-Length': str(os.fstat(datafile.fileno()).st_size)}
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+            self.request('PUT', name, datafile, headers, digest)
+
+    ## Delete the object 'name'
+    def delete(self, name):
+        self.request('DELETE', name)
+
+## Checksum of the content of a file. It is used to check if a file whose
+#  metadata changed has really changed.
+def fileChecksum(filename):
+    hash = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
 
-    try:
-        subdirectory_default_language = config['DEFAULT_LANGUAGE_SUBDIRECTORY']
-    except KeyError:
-        pass
-    # Load global locale if it is present
-    try:
-        loadLocale(working_path)
-    except FileNotFoundError:
-        pass
-
-    # Build all except links
-    logging.info('Building pages...')
-    exploreSubdirectory(working_path + source_path,
-                        processDirectory,
-                        releaseDirectory)
-    #Build links
-    logging.info('Building links...')
-    exploreSubdirectory(working_path + public_path, buildLinks)
-
-    # Copy static files to public directory
-    logging.info('Copying static files...')
-    if static_file_list == None:
-        # copy all files
-        logging.info('Copy all')
-        shutil.copytree(working_path + static_path,
-                        working_path + public_path + config['STATIC'])
-    else:
-        # copy from list
-        logging.info('Copy from list {}'.format(static_file_list))
+## Detects changes by comparing snapshots of the metadata (modification time,
+#  size and inode) of all files. Only files whose metadata changed are read,
+#  to check that their content is really different.
+class PollingWatcher:
+    def __init__(self, directories):
+        self.directories = directories
+        self.snapshot = self.scan()
+        self.checksums = {}
+
+    ## Return a dictionary with the metadata of every file
+    def scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            for dirpath, dirnames, filenames in os.walk(directory, topdown=True, followlinks=False):
+                dirnames[:] = [name for name in dirnames if name not in exclude_dirs]
+                for filename in filenames:
+                    if filename in excluding_files:
+                        continue
+                    filepath = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(filepath)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[filepath] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return snapshot
+
+    ## Return the set of files changed since the last call
+    def changes(self):
+        snapshot = self.scan()
+        changed = set()
+        for filepath in self.snapshot.keys() | snapshot.keys():
+            old_state, new_state = self.snapshot.get(filepath), snapshot.get(filepath)
+            if old_state == new_state:
+                continue
+            if old_state is None or new_state is None:
+                self.checksums.pop(filepath, None)
+                changed.add(filepath)
+                continue
+            try:
+                checksum = fileChecksum(filepath)
+            except OSError:
+                checksum = None
+            if checksum is None or self.checksums.get(filepath) != checksum:
+                changed.add(filepath)
+            self.checksums[filepath] = checksum
+        self.snapshot = snapshot
+        return changed
+
+## Detects changes with the inotify API of Linux. Every directory is watched,
+#  and the events are read without blocking when changes are requested.
+class InotifyWatcher:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directories):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # Dictionary of watched directories: watch descriptor -> path
+        self.watches = {}
         try:
-            staticFilesFromList(static_file_list)
-        except FileNotFoundError as e:
-            logging.error("{} not found! No static file copied.".format(static_file_list))
-
-## Checksum of a directory. It can be used to check if a file has changed
-# Credits: https://stackoverflow.com/a/7325320
-def directoriesChecksum(directories):
-    hash = hashlib.md5()
-    for directory in directories:
+            for directory in directories:
+                self.addTree(directory)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    ## Watch directory and all its subdirectories. If changed is given, the
+    #  files already there are added to it, since they were created before
+    #  the watch.
+    def addTree(self, directory, changed = None):
         for dirpath, dirnames, filenames in os.walk(directory, topdown=True, followlinks=False):
-            # skip all pat containing .git or venv
-            if any(exclude_dir in dirpath for exclude_dir in exclude_dirs):
-                continue
-            logging.debug(f'Exploring {dirpath} - {os.path.basename(dirpath)}')
-            dirnames.sort(key=os.path.normcase)
-            filenames.sort(key=os.path.normcase)
-            for filename in filenames:
-                if filename in excluding_files:
+            dirnames[:] = [name for name in dirnames if name not in exclude_dirs]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed on {dirpath}')
+            self.watches[wd] = dirpath
+            if changed is not None:
+                changed.update(os.path.join(dirpath, filename) for filename in filenames
+                               if filename not in excluding_files)
+
+    ## Stop watching directory and all its subdirectories
+    def removeTree(self, directory):
+        for wd, dirpath in list(self.watches.items()):
+            if dirpath == directory or dirpath.startswith(directory + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    ## Return the set of paths changed since the last call, or None if some
+    #  events were lost and it is unknown what changed.
+    def changes(self):
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + length].rstrip(b'\0'))
+                offset += self.EVENT_HEADER.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if name in excluding_files or (mask & self.IN_ISDIR and name in exclude_dirs):
                     continue
-                filepath = os.path.join(dirpath, filename)
 
-                f = open(filepath, 'rb')
-                for chunk in iter(lambda: f.read(65536), b''):
-                    hash.update(chunk)
-    return hash.hexdigest()
+                path = os.path.join(directory, name) if name else directory
+                changed.add(path)
+                if mask & self.IN_ISDIR:
+                    if mask & self.IN_MOVED_FROM:
+                        self.removeTree(path)
+                    elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.addTree(path, changed)
+        return None if overflow else changed
+
+## Return the best available watcher for the directories: inotify on Linux,
+#  otherwise (or if inotify can't be used) the polling one.
+def createWatcher(directories):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as e:
+            logging.warning(f'inotify not available ({e}), checking files for changes periodically.')
+    return PollingWatcher(directories)
+
+## Schedules the builds of watch mode in a thread. The changes notified
+#  (see notify) are collected, and a build starts when nothing changed for
+#  'debounce' seconds, with all of them. If something changes during a build,
+#  the build is cancelled (see Builder.cancel) and its changes are built with
+#  the new ones. 'build' is called with the paths changed (None if unknown)
+#  to build the website of 'builder'.
+class BuildScheduler:
+    def __init__(self, builder, build, debounce = watch_debounce_time):
+        self.builder = builder
+        self.build = build
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        # Paths changed and not built yet (None if unknown), if 'pending'
+        self.changed_paths = set()
+        self.pending = False
+        self.last_change = 0
+        self.stopped = False
+        # Status of the builds, see getStatus
+        self.state = 'idle'
+        self.builds = 0
+        self.last_duration = None
+        self.last_build = None
+        self.last_error = None
+        self.thread = threading.Thread(target = self.run, name = 'build_scheduler', daemon = True)
+        self.thread.start()
+
+    ## Notify the paths changed ('paths' is None if it is unknown what changed)
+    def notify(self, paths):
+        with self.condition:
+            if paths is None or self.changed_paths is None:
+                self.changed_paths = None
+            else:
+                self.changed_paths.update(paths)
+            self.pending = True
+            self.last_change = time.monotonic()
+            if self.state == 'building':
+                self.builder.cancel()
+            self.condition.notify()
+
+    ## Stop scheduling builds, cancelling the one running, and wait for it
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            if self.state == 'building':
+                self.builder.cancel()
+            self.condition.notify()
+        self.thread.join()
+
+    ## Return a dictionary with the status of the builds: the state ('idle',
+    #  'waiting' for the changes to settle, 'building' or 'failed'), the
+    #  number of builds completed, the seconds taken by the last one and when
+    #  it ended, the error of the last build failed.
+    def getStatus(self):
+        with self.condition:
+            return {'state': 'waiting' if self.pending and self.state != 'building' else self.state,
+                    'builds': self.builds,
+                    'last_duration': self.last_duration,
+                    'last_build': self.last_build,
+                    'error': self.last_error}
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                # Wait for the changes to settle
+                while not self.stopped and time.monotonic() < self.last_change + self.debounce:
+                    self.condition.wait(self.last_change + self.debounce - time.monotonic())
+                if self.stopped:
+                    return
+                changed_paths = self.changed_paths
+                self.changed_paths = set()
+                self.pending = False
+                self.state = 'building'
+
+            start = time.perf_counter()
+            try:
+                self.build(changed_paths)
+                state, error = 'idle', None
+            except BuildCancelled:
+                logging.info('Build cancelled, something changed.')
+                state, error = 'cancelled', None
+            except Exception as e:
+                logging.exception('Build failed')
+                state, error = 'failed', f'{type(e).__name__}: {e}'
+
+            with self.condition:
+                if state == 'cancelled':
+                    if changed_paths is None or self.changed_paths is None:
+                        self.changed_paths = None
+                    else:
+                        self.changed_paths.update(changed_paths)
+                    self.state = 'idle'
+                else:
+                    self.state = state
+                    self.last_error = error
+                    self.builds += 1
+                    self.last_duration = time.perf_counter() - start
+                    self.last_build = datetime.datetime.now().isoformat(timespec = 'seconds')
+
+## Pages of the last builds kept in memory for the web server of watch mode.
+#  During a build pages are staged (up to 'budget' bytes), and they are served
+#  only after the build is committed. The digests of all pages are kept, to
+#  know which pages really changed. Pages are evicted when they exceed the
+#  budget, and then they are read from public_path.
+class MemoryPages:
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.pages = collections.OrderedDict()
+        self.size = 0
+        self.digests = {}
+        self.staged = {}
+        self.staged_size = 0
+
+    ## Stage the page in 'path' (relative to public_path) just built
+    def stage(self, path, data):
+        if self.staged_size + len(data) <= self.budget:
+            self.staged[path] = data
+            self.staged_size += len(data)
+
+    ## Serve the pages built, given their digests, and forget the pages not in
+    #  'all_paths'. It returns the paths of the pages that changed.
+    def commit(self, digests, all_paths):
+        changed = []
+        with self.lock:
+            for path, digest in digests.items():
+                if self.digests.get(path) != digest:
+                    changed.append(path)
+                    self.digests[path] = digest
+                if path in self.pages:
+                    self.size -= len(self.pages.pop(path))
+                if path in self.staged:
+                    self.pages[path] = self.staged[path]
+                    self.size += len(self.staged[path])
+            for path in [path for path in self.digests if path not in all_paths]:
+                changed.append(path)
+                del self.digests[path]
+                if path in self.pages:
+                    self.size -= len(self.pages.pop(path))
+            while self.size > self.budget:
+                self.size -= len(self.pages.popitem(last = False)[1])
+            self.staged = {}
+            self.staged_size = 0
+        return changed
+
+    ## Forget the pages staged by a build that was not committed
+    def rollback(self):
+        self.staged = {}
+        self.staged_size = 0
+
+    ## Return the page in 'path', or None if it is not in memory
+    def get(self, path):
+        with self.lock:
+            data = self.pages.get(path)
+            if data is not None:
+                self.pages.move_to_end(path)
+            return data
+
+## Inverted index of the pages for the search in the browser, updated
+#  incrementally as pages are built (see update). For each language it has the
+#  list of documents (the URL and the title of the pages, None for the ids no
+#  longer used) and the postings of each term: a dictionary whose keys are the
+#  ids of the documents containing it and the values the number of occurrences.
+#  Only the shards whose terms changed are written again (see write).
+class SearchIndex:
+    def __init__(self):
+        # Documents of each page, by the directory of its source: a dictionary
+        # whose keys are languages and values (path, title, terms)
+        self.pages = {}
+        self.ids = {}
+        self.documents = {}
+        self.free_ids = {}
+        self.postings = {}
+        self.shards = {}
+        self.changed_shards = set()
+        self.changed_documents = set()
+        # URL of the website when the documents were written, None if they never were
+        self.location = None
+
+    ## Load the index saved in 'filename' by a previous run. It returns None if
+    #  it is missing or it was saved by another version of swamp.
+    @staticmethod
+    def load(filename):
+        try:
+            with open(filename, 'rb') as indexfile:
+                index_data = pickle.load(indexfile)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return None
+        if index_data.get('version') != getSwampVersion():
+            return None
+        index = SearchIndex()
+        index.__dict__.update(index_data['index'])
+        return index
+
+    ## Save the index in 'filename', for the next run
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        with open(filename + '.tmp', 'wb') as indexfile:
+            pickle.dump({'version': getSwampVersion(), 'index': self.__dict__}, indexfile, pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename)
+
+    ## Replace the documents of the pages built, in 'pages' (see
+    #  Builder.buildPage), and remove the pages whose directory is not in
+    #  'all_paths'.
+    def update(self, pages, all_paths):
+        changed_pages = {path: {} for path in self.pages if path not in all_paths}
+        changed_pages.update(pages)
+        old_pages = {path: self.pages.pop(path, {}) for path in changed_pages}
+
+        # Documents whose path changed are removed first, as the path can be used by another page
+        for path, old_documents in old_pages.items():
+            for lang, (page_path, title, terms) in old_documents.items():
+                if lang not in changed_pages[path] or changed_pages[path][lang][0] != page_path:
+                    document_id = self.ids[lang].pop(page_path)
+                    self.setTerms(lang, document_id, terms, {})
+                    self.documents[lang][document_id] = None
+                    self.free_ids[lang].append(document_id)
+                    self.changed_documents.add(lang)
+
+        for path, documents in changed_pages.items():
+            for lang, (page_path, title, terms) in documents.items():
+                old_terms = {}
+                if page_path in self.ids.setdefault(lang, {}):
+                    document_id = self.ids[lang][page_path]
+                    old_terms = old_pages[path][lang][2]
+                elif self.free_ids.setdefault(lang, []):
+                    document_id = self.free_ids[lang].pop()
+                else:
+                    document_id = len(self.documents.setdefault(lang, []))
+                    self.documents[lang].append(None)
+                self.ids[lang][page_path] = document_id
+                self.setTerms(lang, document_id, old_terms, terms)
+                if self.documents[lang][document_id] != [page_path, title]:
+                    self.documents[lang][document_id] = [page_path, title]
+                    self.changed_documents.add(lang)
+            if documents:
+                self.pages[path] = documents
+
+    ## Replace the terms 'old_terms' of the document 'document_id' with 'terms'
+    def setTerms(self, lang, document_id, old_terms, terms):
+        postings = self.postings.setdefault(lang, {})
+        shards = self.shards.setdefault(lang, {})
+        for term in old_terms.keys() - terms.keys():
+            shard = searchShardName(term)
+            del postings[term][document_id]
+            if not postings[term]:
+                del postings[term]
+                shards[shard].discard(term)
+            self.changed_shards.add((lang, shard))
+        for term, count in terms.items():
+            if old_terms.get(term) != count:
+                shard = searchShardName(term)
+                postings.setdefault(term, {})[document_id] = count
+                shards.setdefault(shard, set()).add(term)
+                self.changed_shards.add((lang, shard))
+
+    ## Write the documents and the shards that changed in 'directory', with a
+    #  directory for each language, and remove the ones no longer used. The URLs
+    #  of the documents start with 'location'. It returns the dictionary of the
+    #  files of the index: each key is the name of the file relative to
+    #  'directory' and its value the path of the file, and if some of them
+    #  changed.
+    def write(self, directory, location):
+        changed = bool(self.changed_shards or self.changed_documents)
+        if location != self.location:
+            self.changed_documents.update(self.documents)
+            if self.location is None:
+                # Files written by other indexes are not reliable
+                self.changed_shards.update((lang, shard) for lang, shards in self.shards.items() for shard in shards)
+            changed = True
+            self.location = location
+
+        def writeFile(name, content):
+            filename = directory + name
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+            # The file is replaced, not to write through a hardlink to a published file
+            with open(filename + '.tmp', 'w') as indexfile:
+                json.dump(content, indexfile, ensure_ascii = False, separators = (',', ':'))
+            os.replace(filename + '.tmp', filename)
+
+        for lang in self.changed_documents:
+            writeFile(f'{lang}/{search_documents_name}',
+                      {'prefix': search_shard_prefix,
+                       'documents': [[location + document[0], document[1]] if document is not None else None
+                                     for document in self.documents[lang]]})
+        for lang, shard in self.changed_shards:
+            terms = self.shards[lang].get(shard)
+            if terms:
+                writeFile(f'{lang}/{shard}.json',
+                          {term: sorted(self.postings[lang][term].items()) for term in sorted(terms)})
+            else:
+                self.shards[lang].pop(shard, None)
+        self.changed_documents.clear()
+        self.changed_shards.clear()
 
-## Request handler for the web server
+        files = {f'{lang}/{search_documents_name}': directory + f'{lang}/{search_documents_name}' for lang in self.documents}
+        files.update((f'{lang}/{shard}.json', directory + f'{lang}/{shard}.json') for lang, shards in self.shards.items() for shard in shards)
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), directory).replace(os.sep, '/')
+                if name not in files:
+                    os.remove(os.path.join(dirpath, filename))
+        return files, changed
+
+## Request handler for the web server. Pages of the last build are served from
+#  memory, when possible. Responses have a strong ETag and are compressed with
+#  gzip if the browser accepts it. HTML pages get a script that reloads them
+#  when they change, and the status of the builds is at build_status_url.
+#  The builder of the website and the scheduler of its builds are the
+#  attributes 'builder' and 'scheduler' of the server.
 class PublicHttpHandler(SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=working_path+public_path, **kwargs)
+    def __init__(self, request, client_address, server):
+        self.builder = server.builder
+        super().__init__(request, client_address, server, directory=self.builder.working_path+public_path)
+
+    def do_GET(self):
+        url_path = urllib.parse.urlsplit(self.path).path
+        if url_path == live_reload_url:
+            self.sendReloadEvents()
+        elif url_path == build_status_url:
+            self.sendBuildStatus()
+        elif not self.sendContent(head = False):
+            super().do_GET()
+
+    def do_HEAD(self):
+        if not self.sendContent(head = True):
+            super().do_HEAD()
+
+    ## Return the content of the requested file and its type, or None if it
+    #  must be handled by SimpleHTTPRequestHandler (missing files, directory
+    #  listings, redirects and big files).
+    def getContent(self):
+        url_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if url_path.endswith('/') and self.builder.memory_pages is not None:
+            data = self.builder.memory_pages.get(makePathStartWithoutSlash(url_path))
+            if data is not None:
+                return data, 'text/html'
+
+        filename = self.translate_path(self.path)
+        if os.path.isdir(filename):
+            if not url_path.endswith('/'):
+                return None
+            filename = os.path.join(filename, 'index.html')
+        try:
+            if os.path.getsize(filename) > dev_server_max_file_size:
+                return None
+            with open(filename, 'rb') as datafile:
+                return datafile.read(), self.guess_type(filename)
+        except OSError:
+            return None
+
+    ## Send the requested file. It returns False if it was not possible.
+    def sendContent(self, head):
+        content = self.getContent()
+        if content is None:
+            return False
+        data, content_type = content
+
+        if content_type == 'text/html':
+            body_end = data.lower().rfind(b'</body>')
+            if body_end == -1:
+                body_end = len(data)
+            data = data[:body_end] + live_reload_script.encode('utf-8') + data[body_end:]
+
+        compressed = False
+        if (content_type.startswith('text/') or content_type in compressible_types) and self.acceptsGzip():
+            data = gzip.compress(data, mtime = 0)
+            compressed = True
+        etag = '"{}"'.format(sha256(data).hexdigest()[:32])
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return True
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type + ('; charset=utf-8' if content_type.startswith('text/') else ''))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', 'no-cache')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+        return True
+
+    ## True if the request accepts responses compressed with gzip
+    def acceptsGzip(self):
+        for encoding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, parameters = encoding.strip().partition(';')
+            if name.strip() in ('gzip', '*'):
+                return parameters.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
+
+    ## Send the status of the builds as JSON (see BuildScheduler.getStatus)
+    def sendBuildStatus(self):
+        scheduler = self.server.scheduler
+        data = json.dumps(scheduler.getStatus() if scheduler is not None else None).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    ## Keep the connection open as a Server-Sent Events stream, sending the
+    #  URLs changed after each build.
+    def sendReloadEvents(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        client = queue.Queue()
+        with self.builder.live_reload_lock:
+            self.builder.live_reload_clients.add(client)
+        try:
+            while True:
+                try:
+                    message = client.get(timeout = 15)
+                except queue.Empty:
+                    message = ': keep-alive\n\n'
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.builder.live_reload_lock:
+                self.builder.live_reload_clients.discard(client)
+        self.close_connection = True
 
 
 
@@ -576,6 +3421,29 @@ def main(args):
                            help = """file containg a list of static files to be
                                      included when bulding the website""")
 
+    argparser.add_argument('--staticmode',
+                           action = 'store',
+                           choices = ['copy', 'hardlink', 'reflink'],
+                           default = 'copy',
+                           help = """How static files are published: copied (default), hardlinked or
+                                     reflinked (if the filesystem does not support it, they are copied).""")
+
+    argparser.add_argument('--staticchecksum',
+                           action = 'store_true',
+                           help = """Compares the content of static files with the published ones when
+                                     their modification time differs, instead of copying them.""")
+
+    argparser.add_argument('--fingerprint',
+                           action = 'store_true',
+                           help = f"""Publishes static files also with the digest of their content in the name,
+                                     used by the links {{_static:name_}}, and writes {asset_manifest_name}.""")
+
+    argparser.add_argument('-s', '--staged',
+                           action = 'store_true',
+                           help = """Builds the website in a staging directory that replaces the public
+                                     directory at the end, so it is never partially built.
+                                     Always used in Watch Mode.""")
+
     argparser.add_argument('-w', '--watch',
                            action = 'store_true',
                            help = """Watch Mode. The program keep refreshing the output.\n
@@ -590,6 +3458,71 @@ def main(args):
                            help = f"""Address of the web server. Default is {default_webserver_address}.\n
                                      Works only in WatchMode.""")
 
+    argparser.add_argument('-c', '--cache',
+                           action = 'store_true',
+                           help = """Keeps a build cache, so that only the pages that changed since
+                                     the last build are built again.""")
+
+    argparser.add_argument('-j', '--jobs',
+                           action = 'store',
+                           type = int,
+                           default = 1,
+                           help = """Number of processes building the pages. Default is 1.""")
+
+    argparser.add_argument('--strict',
+                           action = 'store_true',
+                           help = """Strict Mode. Undefined variables are errors instead of being
+                                     rendered as "None". The website is built in a staging directory
+                                     (see --staged), so it is not published if a variable is undefined.""")
+
+    argparser.add_argument('--minify',
+                           action = 'store',
+                           nargs = '?',
+                           const = 'whitespace',
+                           choices = ['whitespace', 'quotes'],
+                           help = """Minifies the HTML code: 'whitespace' (default) collapses whitespaces,
+                                     'quotes' also removes the quotes not needed around attribute values.""")
+
+    argparser.add_argument('--precompress',
+                           action = 'store_true',
+                           help = f"""Writes a gzip (.gz) and a brotli (.br) compressed copy of every page and
+                                     text static file bigger than {precompress_min_size} bytes, to be served by
+                                     web servers without compressing them at every request.""")
+
+    argparser.add_argument('--search',
+                           action = 'store_true',
+                           help = f"""Publishes a search index of the pages in the directory {search_directory} of
+                                     the static files, with a directory for each language, split in shards
+                                     so that the browser downloads only the ones of the words searched.""")
+
+    argparser.add_argument('--profile',
+                           action = 'store_true',
+                           help = f"""Profiles the build: the time of each phase and page, and the counters of
+                                     expressions and bytes, are written in {cache_path}profile.json,
+                                     and the trace events (for chrome://tracing) in {cache_path}trace.json.""")
+
+    argparser.add_argument('--manifest',
+                           action = 'store_true',
+                           help = f"""Writes {cache_path}{deploy_manifest_name}, with the SHA-256, size and type of
+                                     every published file and the files added, changed and removed since
+                                     the previous build.""")
+
+    argparser.add_argument('--upload',
+                           action = 'store',
+                           metavar = 'DESTINATION',
+                           help = """Uploads the website to DESTINATION (s3://bucket/prefix) after the build,
+                                     with an S3-compatible API: only the files changed since the last upload
+                                     are uploaded. The endpoint and the credentials are read from the
+                                     environment variables AWS_ENDPOINT_URL, AWS_REGION, AWS_ACCESS_KEY_ID
+                                     and AWS_SECRET_ACCESS_KEY.""")
+
+    argparser.add_argument('--debounce',
+                           action = 'store',
+                           type = float,
+                           default = watch_debounce_time,
+                           help = f"""Seconds without changes before a build starts in Watch Mode, so that
+                                     many changes at once are built together. Default is {watch_debounce_time}.""")
+
     args_dictionary = vars(argparser.parse_args(args[1:])) # devo skippare il main.py come argomento
 
     # Debug?
@@ -606,8 +3539,16 @@ def main(args):
     if args_dictionary['port'] is not None:
         webserver_port = int(args_dictionary['port'])
 
+    builder = Builder(working_path)
     if args_dictionary['watch']:
-        http_server = HTTPServer((webserver_address, webserver_port), PublicHttpHandler)
+        # Builds run in the thread of the scheduler, so they can not be forked
+        if args_dictionary['jobs'] > 1:
+            logging.warning('Pages are built by a single process in Watch Mode.')
+            args_dictionary['jobs'] = 1
+        builder.memory_pages = MemoryPages(dev_server_memory)
+        http_server = ThreadingHTTPServer((webserver_address, webserver_port), PublicHttpHandler)
+        http_server.builder = builder
+        http_server.scheduler = None
         server_thread = threading.Thread(target=http_server.serve_forever, daemon=True)
         server_thread.start()
         logging.info(f'Web server started at address {webserver_address}:{webserver_port}.')
@@ -639,23 +3580,49 @@ def main(args):
         # Avoid exiting when Ctrl-C is pressed
         signal.signal(signal.SIGINT, sigint_handler)
     
-    checksum_source_directory = 'wrong_checksum'
-    
-    while True:
-        actual_checksum = directoriesChecksum([working_path])
-        if checksum_source_directory != actual_checksum:
-            logging.info(f'Generating website at {datetime.datetime.now()}')
-            logging.debug('Checksum old {0} new {1}'.format(checksum_source_directory, actual_checksum))
-            generateWebsite(static_file_list = args_dictionary['staticlist'])
-            checksum_source_directory = actual_checksum
+    # Build the website, and upload it if requested
+    def build(changed_paths):
+        logging.info(f'Generating website at {datetime.datetime.now()}')
+        builder.generateWebsite(static_file_list = args_dictionary['staticlist'],
+                                incremental = args_dictionary['watch'],
+                                changed_paths = changed_paths,
+                                jobs = args_dictionary['jobs'],
+                                cache = args_dictionary['cache'],
+                                static_mode = args_dictionary['staticmode'],
+                                static_checksum = args_dictionary['staticchecksum'],
+                                staged = args_dictionary['staged'] or args_dictionary['watch'],
+                                strict = args_dictionary['strict'],
+                                minify = args_dictionary['minify'],
+                                profile_build = args_dictionary['profile'],
+                                fingerprint = args_dictionary['fingerprint'],
+                                deploy_manifest = args_dictionary['manifest'] or args_dictionary['upload'] is not None,
+                                precompress = args_dictionary['precompress'],
+                                search = args_dictionary['search'])
+        if args_dictionary['upload'] is not None:
+            builder.uploadWebsite(args_dictionary['upload'])
+
+    if not args_dictionary['watch']:
+        build(None)
+        logging.info('Ending...')
+        return 0
+
+    # Watching starts before the first build, so nothing is missed. Builds
+    # run in the thread of the scheduler, while changes are collected here.
+    watcher = createWatcher([builder.working_path])
+    scheduler = BuildScheduler(builder, build, args_dictionary['debounce'])
+    http_server.scheduler = scheduler
+    scheduler.notify(None)
+    while keep_going[0]:
         time.sleep(watch_waiting_time)
-        if not keep_going[0]:
-            break
+        changed_paths = watcher.changes()
+        if changed_paths is None or changed_paths:
+            logging.debug(f'Changed paths: {changed_paths}')
+            scheduler.notify(changed_paths)
+    scheduler.stop()
 
     logging.info('Ending...')
     return 0
 
 
 if __name__ == '__main__':
-    import sys
     sys.exit(main(sys.argv))